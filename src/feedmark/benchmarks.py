@@ -0,0 +1,541 @@
+# Microbenchmarks for Feedmark.  Run like the tests, from the root of the
+# repository:
+#
+#     PYTHONPATH=src python3 src/feedmark/benchmarks.py [NAME...]
+#
+# With no names given, all benchmarks are run.
+
+from __future__ import print_function
+
+import codecs
+from subprocess import check_call
+from tempfile import mkdtemp
+import gc
+import json
+import os
+import sys
+import time
+
+from feedmark.formats.markdown import fragment_cache
+from feedmark.loader import DocumentCache, read_document_from
+from feedmark.parser import Parser
+
+
+def make_document(num_sections, title='Benchmark Sightings'):
+    """Return the text of a synthetic Feedmark document with the given number
+    of sections, exercising images, both kinds of properties, and reference links."""
+    lines = [
+        u'# {}'.format(title),
+        u'',
+        u'*   author: Alfred J. Prufrock',
+        u'*   url: http://example.com/bench.xml',
+        u'*   link-target-url: http://example.com/bench.html',
+        u'',
+        u'Some **llamas** have been [spotted][] recently.',
+        u'',
+        u'[spotted]: spotted.html',
+    ]
+    for n in range(num_sections):
+        lines.extend([
+            u'',
+            u'### Llama Sighting Number {}'.format(n),
+            u'',
+            u'![photo of possible llama](https://example.com/llama{}.jpg)'.format(n),
+            u'',
+            u'*   date: Jan {} {} 12:00:00'.format(n % 28 + 1, 1900 + n % 120),
+            u'*   reporter: Gregor Samsa',
+            u'*   genre @ [Camelid][]',
+            u'*   genre @ Mammal',
+            u'',
+            u'A llama was _possibly_ sighted near [the mall][] at {} o\'clock.'.format(n % 12),
+            u'It was **striped**, and see also [Markdown](https://daringfireball.net/projects/markdown/).',
+            u'',
+            u'Lorem ipsum dolor sit amet, consectetur adipiscing elit. In quis finibus nisl.',
+            u'',
+            u'[Camelid]: https://en.wikipedia.org/wiki/Camelidae',
+            u'[the mall]: mall.html',
+        ])
+    lines.append(u'')
+    return u'\n'.join(lines)
+
+
+def timeit(fun, repeat=5):
+    """Return the best wall-clock time, in seconds, of `repeat` calls to `fun`."""
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        fun()
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def bench_parser():
+    for num_sections in (100, 1000, 10000):
+        text = make_document(num_sections)
+        elapsed = timeit(lambda: Parser(text).parse_document())
+        print("parser: {} sections, {} bytes: {:.4f}s ({:.0f} lines/s)".format(
+            num_sections, len(text), elapsed, text.count('\n') / elapsed
+        ))
+
+
+def write_corpus(dirname, num_documents, num_sections):
+    filenames = []
+    for n in range(num_documents):
+        filename = os.path.join(dirname, 'Document {}.md'.format(n))
+        with open(filename, 'wb') as f:
+            f.write(make_document(num_sections, title='Document {}'.format(n)).encode('utf-8'))
+        filenames.append(filename)
+    return filenames
+
+
+def bench_cache():
+    dirname = mkdtemp()
+    try:
+        filenames = write_corpus(dirname, 300, 50)
+        cache = DocumentCache(os.path.join(dirname, 'cache'))
+
+        def load(cache=None):
+            for filename in filenames:
+                read_document_from(filename, cache=cache)
+
+        print("cache: 300 documents, stat only: {:.4f}s".format(
+            timeit(lambda: [os.stat(filename) for filename in filenames])
+        ))
+        print("cache: 300 documents, uncached: {:.4f}s".format(timeit(load)))
+        print("cache: 300 documents, cold cache: {:.4f}s".format(
+            timeit(lambda: (cache.clear(), load(cache=cache)))
+        ))
+        print("cache: 300 documents, warm cache: {:.4f}s".format(timeit(lambda: load(cache=cache))))
+    finally:
+        check_call(["rm", "-rf", dirname])
+
+
+def bench_htmlize():
+    document = Parser(make_document(500)).parse_document()
+    document.filename = 'bench.md'
+    elapsed = timeit(lambda: (fragment_cache.clear(), document.to_json_data(htmlize=True)), repeat=3)
+    print("htmlize: 500 sections to htmlized JSON: {:.4f}s ({} fragment cache hits, {} misses)".format(
+        elapsed, fragment_cache.hits, fragment_cache.misses
+    ))
+
+
+def bench_memory():
+    try:
+        import tracemalloc
+    except ImportError:
+        print("memory: tracemalloc not available")
+        return
+    texts = [make_document(100, title='Document {}'.format(n)) for n in range(100)]
+    tracemalloc.start()
+    documents = [Parser(text).parse_document() for text in texts]
+    gc.collect()
+    (current, peak) = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print("memory: {} documents, {} sections: {:.1f}MB".format(
+        len(documents), sum(len(d.sections) for d in documents), current / (1024.0 * 1024.0)
+    ))
+
+
+def bench_sort():
+    from feedmark.feeds import extract_sections
+
+    text = make_document(20000)
+    # each run must start from freshly parsed sections
+    documents = iter([Parser(text).parse_document() for n in range(3)])
+    elapsed = timeit(lambda: extract_sections([next(documents)]), repeat=3)
+    print("sort: 20000 sections by publication date: {:.4f}s".format(elapsed))
+
+
+def bench_feed():
+    from feedmark.formats.atom import feedmark_atomize
+
+    document = Parser(make_document(5000)).parse_document()
+    dirname = mkdtemp()
+    try:
+        out_filename = os.path.join(dirname, 'feed.xml')
+        for limit in (20, None):
+            elapsed = timeit(lambda: feedmark_atomize([document], out_filename, limit=limit), repeat=1)
+            print("feed: Atom feed of {} entries from 5000 sections: {:.4f}s".format(limit or 'all', elapsed))
+        for jobs in (2, 4):
+            elapsed = timeit(lambda: feedmark_atomize([document], out_filename, jobs=jobs), repeat=1)
+            print("feed: Atom feed of all entries from 5000 sections, {} jobs: {:.4f}s".format(jobs, elapsed))
+    finally:
+        check_call(["rm", "-rf", dirname])
+
+
+def bench_feeds():
+    from feedmark.main import main
+
+    dirname = mkdtemp()
+    try:
+        filenames = write_corpus(dirname, 10, 200)
+        spec_filename = os.path.join(dirname, 'feeds.md')
+        feeds = [([filename], [], os.path.join(dirname, 'doc{}.xml'.format(n))) for (n, filename) in enumerate(filenames)]
+        feeds.append((filenames, [], os.path.join(dirname, 'all.xml')))
+        feeds.append((filenames, ['reporter=Gregor Samsa'], os.path.join(dirname, 'samsa.xml')))
+        feeds.append((filenames, ['genre=Mammal'], os.path.join(dirname, 'mammal.xml')))
+        lines = [u'# Feeds']
+        for (n, (feed_filenames, conditions, output)) in enumerate(feeds):
+            lines.extend([u'', u'### Feed {}'.format(n), u'', u'*   output: {}'.format(output)])
+            if len(feed_filenames) == 1:
+                lines.append(u'*   document: {}'.format(feed_filenames[0]))
+            lines.extend(u'*   where: {}'.format(condition) for condition in conditions)
+            lines.extend([u'', u'A feed.'])
+        lines.append(u'')
+        with codecs.open(spec_filename, 'w', encoding='utf-8') as f:
+            f.write(u'\n'.join(lines))
+
+        def separately():
+            for (feed_filenames, conditions, output) in feeds:
+                main(feed_filenames + ['--output-atom={}'.format(output)] + ['--where={}'.format(c) for c in conditions])
+
+        elapsed = timeit(separately, repeat=1)
+        print("feeds: {} feeds from 10 documents, 2000 sections, one run each: {:.4f}s".format(len(feeds), elapsed))
+        elapsed = timeit(lambda: main(filenames + ['--feed-spec={}'.format(spec_filename)]), repeat=1)
+        print("feeds: {} feeds from 10 documents, 2000 sections, --feed-spec: {:.4f}s".format(len(feeds), elapsed))
+    finally:
+        check_call(["rm", "-rf", dirname])
+
+
+def bench_markdown():
+    from feedmark.formats.markdown import write_markdown
+    from feedmark.utils import StringIO
+
+    for num_sections in (100, 1000, 10000):
+        document = Parser(make_document(num_sections)).parse_document()
+        out = StringIO()
+        elapsed = timeit(lambda: (out.seek(0), write_markdown(document, out)), repeat=3)
+        size = len(out.getvalue())
+        print("markdown: {} sections, {} bytes: {:.4f}s ({:.1f} MB/s)".format(
+            num_sections, size, elapsed, size / elapsed / (1024.0 * 1024.0)
+        ))
+
+
+def bench_html():
+    from feedmark.formats.markdown import feedmark_htmlize, feedmark_htmlize_whole, section_cache
+
+    document = Parser(make_document(2000)).parse_document()
+    print("html: 2000 sections, whole document: {:.4f}s".format(
+        timeit(lambda: feedmark_htmlize_whole(document), repeat=3)
+    ))
+    print("html: 2000 sections, section-wise: {:.4f}s".format(
+        timeit(lambda: (section_cache.clear(), feedmark_htmlize(document)), repeat=3)
+    ))
+    print("html: 2000 sections, section-wise, cached: {:.4f}s".format(
+        timeit(lambda: feedmark_htmlize(document), repeat=3)
+    ))
+
+
+def bench_refdex():
+    from feedmark.loader import read_refdex_from
+    from feedmark.refdex import compile_refdex
+
+    dirname = mkdtemp()
+    try:
+        refdex = dict(
+            (u'Entry Number {}'.format(n), {u'filename': u'Document {}.md'.format(n % 100), u'anchor': u'entry-number-{}'.format(n)})
+            for n in range(200000)
+        )
+        json_filename = os.path.join(dirname, 'refdex.json')
+        with open(json_filename, 'w') as f:
+            f.write(json.dumps(refdex))
+        compiled_filename = os.path.join(dirname, 'refdex.db')
+        compile_refdex(refdex, compiled_filename)
+        names = [u'Entry Number {}'.format(n) for n in range(0, 200000, 2000)]
+
+        def lookup(filename):
+            refdex = read_refdex_from([filename])
+            for name in names:
+                refdex[name]
+
+        print("refdex: 200000 entries, load JSON and look up 100: {:.4f}s".format(timeit(lambda: lookup(json_filename), repeat=3)))
+        print("refdex: 200000 entries, open compiled and look up 100: {:.4f}s".format(timeit(lambda: lookup(compiled_filename), repeat=3)))
+    finally:
+        check_call(["rm", "-rf", dirname])
+
+
+def bench_collect_refdex():
+    from feedmark.main import collect_refdex
+    from feedmark.refdex import RefdexBuilder
+
+    dirname = mkdtemp()
+    try:
+        filenames = write_corpus(dirname, 300, 50)
+        documents = [read_document_from(filename) for filename in filenames]
+        elapsed = timeit(lambda: collect_refdex({}, documents))
+        print("collect-refdex: 300 documents, 15000 sections, from scratch: {:.4f}s".format(elapsed))
+        builder = RefdexBuilder()
+        builder.update(documents)
+
+        def refresh():
+            documents[0] = read_document_from(filenames[0])
+            builder.update(documents)
+            builder.collect({})
+
+        elapsed = timeit(refresh)
+        print("collect-refdex: 300 documents, 15000 sections, after re-reading one: {:.4f}s".format(elapsed))
+    finally:
+        check_call(["rm", "-rf", dirname])
+
+
+def bench_rewrite():
+    from feedmark.parser import rewrite_all_reference_links
+
+    dirname = mkdtemp()
+    try:
+        filenames = write_corpus(dirname, 300, 50)
+        refdex = dict(
+            (u'Entry Number {}'.format(n), {u'filename': u'Document {}.md'.format(n % 100), u'anchor': u'entry-number-{}'.format(n)})
+            for n in range(10000)
+        )
+        for name in (u'spotted', u'Camelid', u'the mall'):
+            refdex[name] = {u'filenames': [u'Llama Facts.md'], u'anchor': name.lower().replace(u' ', u'-')}
+
+        def rewrite():
+            # each run must start from freshly read documents
+            documents = [read_document_from(filename) for filename in filenames]
+            start = time.time()
+            rewrite_all_reference_links(documents, refdex)
+            return time.time() - start
+
+        elapsed = min(rewrite() for n in range(3))
+        print("rewrite: 300 documents, 15000 sections, rewrite reference links: {:.4f}s".format(elapsed))
+    finally:
+        check_call(["rm", "-rf", dirname])
+
+
+def bench_serve():
+    import threading
+    from subprocess import check_output
+    from feedmark.server import Corpus, make_server, query
+
+    feedmark = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'bin', 'feedmark')
+    dirname = mkdtemp()
+    try:
+        filenames = write_corpus(dirname, 50, 20)
+        print("serve: 50 documents, 1000 sections, spawn `feedmark --output-json`: {:.4f}s per query".format(
+            timeit(lambda: check_output([sys.executable, feedmark, '--output-json'] + filenames), repeat=3)
+        ))
+        corpus = Corpus(filenames)
+        server = make_server(corpus, port=0)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        try:
+            base_url = 'http://127.0.0.1:{}'.format(server.server_port)
+            for (name, params) in (
+                ('json', {}),
+                ('json', {'document': filenames[0]}),
+                ('by-publication-date', {'limit': 20}),
+                ('refdex', {}),
+            ):
+                elapsed = timeit(lambda: query(name, base_url=base_url, **params), repeat=10)
+                print("serve: 50 documents, 1000 sections, query {}{}: {:.4f}s per query".format(
+                    name, ''.join(' ' + key for key in sorted(params)), elapsed
+                ))
+        finally:
+            server.shutdown()
+            server.server_close()
+            thread.join()
+    finally:
+        check_call(["rm", "-rf", dirname])
+
+
+def bench_where():
+    from feedmark.main import main
+    from feedmark.utils import StringIO
+
+    dirname = mkdtemp()
+    saved_stdout = sys.stdout
+    try:
+        filenames = write_corpus(dirname, 300, 50)
+        with open(filenames[0], 'rb') as f:
+            text = f.read().replace(b'Gregor Samsa', b'Josef K.', 1)
+        with open(filenames[0], 'wb') as f:
+            f.write(text)
+        index_filename = os.path.join(dirname, 'index.json')
+        query = filenames + ['--output-json', '--where=reporter^=Josef']
+
+        def run(args):
+            sys.stdout = StringIO()
+            try:
+                main(args)
+            finally:
+                sys.stdout = saved_stdout
+
+        elapsed = timeit(lambda: run(query), repeat=3)
+        print("where: 300 documents, 15000 sections, --where: {:.4f}s".format(elapsed))
+        run(filenames + ['--property-index={}'.format(index_filename)])
+        elapsed = timeit(lambda: run(query + ['--property-index={}'.format(index_filename)]), repeat=3)
+        print("where: 300 documents, 15000 sections, --where with saved --property-index: {:.4f}s".format(elapsed))
+    finally:
+        sys.stdout = saved_stdout
+        check_call(["rm", "-rf", dirname])
+
+
+FEEDMARK_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'bin', 'feedmark')
+
+
+def import_times(args):
+    """Run `bin/feedmark` with the given arguments under `python -X importtime`
+    (Python 3.7 or later) and return a dict mapping the name of each module it
+    imported to the cumulative time, in seconds, that importing it took."""
+    from subprocess import PIPE, Popen
+
+    process = Popen([sys.executable, '-X', 'importtime', FEEDMARK_SCRIPT] + args, stdout=PIPE, stderr=PIPE)
+    (out, err) = process.communicate()
+    times = {}
+    for line in err.decode('utf-8').split('\n'):
+        if line.startswith('import time:') and '|' in line:
+            (self_us, cumulative_us, name) = line[len('import time:'):].split('|')
+            if cumulative_us.strip().isdigit():
+                times[name.strip()] = int(cumulative_us) / 1000000.0
+    return times
+
+
+def bench_startup():
+    from subprocess import check_call as run
+
+    if sys.version_info < (3, 7):
+        print("startup: -X importtime not available")
+        return
+    times = import_times(['--version'])
+    print("startup: import feedmark.main: {:.4f}s, {} modules".format(times['feedmark.main'], len(times)))
+    with open(os.devnull, 'w') as devnull:
+        elapsed = timeit(lambda: run([sys.executable, FEEDMARK_SCRIPT, '--version'], stdout=devnull))
+    print("startup: feedmark --version: {:.4f}s".format(elapsed))
+
+
+def bench_links():
+    from feedmark import checkers
+    from feedmark.formats.markdown import markdown_to_html5
+
+    document = Parser(make_document(1000)).parse_document()
+    print("links: 1000 sections: {:.4f}s".format(
+        timeit(lambda: checkers.extract_links_from_documents([document]), repeat=3)
+    ))
+
+    # For comparison, the way links were found before: a BeautifulSoup tree for every fragment.
+    try:
+        from bs4 import BeautifulSoup
+        BeautifulSoup('<a href="x">x</a>', 'html.parser').find_all('a')
+    except Exception as e:
+        print("links: BeautifulSoup not usable here, not comparing ({})".format(e.__class__.__name__))
+        return
+
+    def extract_links_with_bs4(markdown_text):
+        soup = BeautifulSoup(markdown_to_html5(markdown_text), 'html.parser')
+        return [link.get('href') for link in soup.find_all('a')]
+
+    saved = checkers.extract_links_from_markdown
+    checkers.extract_links_from_markdown = extract_links_with_bs4
+    try:
+        print("links: 1000 sections, with BeautifulSoup: {:.4f}s".format(
+            timeit(lambda: checkers.extract_links_from_documents([document]), repeat=3)
+        ))
+    finally:
+        checkers.extract_links_from_markdown = saved
+
+
+def bench_linkcheck():
+    if sys.version_info < (3, 7):
+        print("linkcheck: requires Python 3.7")
+        return
+    import threading
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    from feedmark.linkcheck import LinkChecker
+
+    class SlowHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_HEAD(self):
+            time.sleep(0.01)
+            self.send_response(200)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+
+        def log_message(self, *args):
+            pass
+
+    servers = [ThreadingHTTPServer(('127.0.0.1', 0), SlowHandler) for n in range(4)]
+    threads = [threading.Thread(target=server.serve_forever) for server in servers]
+    for thread in threads:
+        thread.start()
+    try:
+        urls = [
+            'http://127.0.0.1:{}/page{}'.format(servers[n % 4].server_port, n % 400)
+            for n in range(1000)
+        ]
+        for connections in (1, 8):
+            elapsed = timeit(lambda: LinkChecker(connections=connections).check_urls(urls), repeat=1)
+            print("linkcheck: 1000 links, 400 distinct, 4 hosts, 10ms each, {} connection(s) per host: {:.4f}s".format(
+                connections, elapsed
+            ))
+    finally:
+        for server in servers:
+            server.shutdown()
+            server.server_close()
+        for thread in threads:
+            thread.join()
+
+
+def bench_schema():
+    from feedmark.checkers import Schema
+
+    schema = Schema(Parser(u"""# Schema
+
+### date
+
+The date.
+
+### reporter
+
+*   optional: true
+
+Who reported it.
+
+### genre
+
+*   optional: true
+
+What it is.
+
+### location
+
+*   optional: true
+
+Where it was.
+
+""").parse_document())
+    document = Parser(make_document(20000)).parse_document()
+    print("schema: 20000 sections: {:.4f}s".format(timeit(lambda: schema.check_documents([document]))))
+
+
+BENCHMARKS = [
+    ('parser', bench_parser),
+    ('cache', bench_cache),
+    ('htmlize', bench_htmlize),
+    ('memory', bench_memory),
+    ('sort', bench_sort),
+    ('feed', bench_feed),
+    ('feeds', bench_feeds),
+    ('markdown', bench_markdown),
+    ('html', bench_html),
+    ('refdex', bench_refdex),
+    ('collect-refdex', bench_collect_refdex),
+    ('rewrite', bench_rewrite),
+    ('serve', bench_serve),
+    ('where', bench_where),
+    ('startup', bench_startup),
+    ('links', bench_links),
+    ('linkcheck', bench_linkcheck),
+    ('schema', bench_schema),
+]
+
+
+if __name__ == '__main__':
+    names = sys.argv[1:]
+    for (name, fun) in BENCHMARKS:
+        if not names or name in names:
+            fun()
@@ -1,10 +1,131 @@
 from __future__ import absolute_import
 
+try:
+    from html.parser import HTMLParser
+except ImportError:
+    from HTMLParser import HTMLParser
+
+from datetime import datetime
+from functools import partial
+import re
+
 from feedmark.formats.markdown import markdown_to_html5
-from feedmark.utils import items
+from feedmark.utils import items, pool_map
+
+
+# Stricter than int() and float(), which also accept such things as
+# `1_000`, `nan` and `inf`.
+INTEGER_RE = re.compile(r'-?[0-9]+\Z')
+NUMBER_RE = re.compile(r'-?(?:[0-9]+(?:\.[0-9]*)?|\.[0-9]+)(?:[eE][-+]?[0-9]+)?\Z')
+
+
+def check_integer(value):
+    if not INTEGER_RE.match(value):
+        raise ValueError("not an integer")
+
+
+def check_number(value):
+    if not NUMBER_RE.match(value):
+        raise ValueError("not a number")
+
+
+def check_boolean(value):
+    if value not in ('true', 'false'):
+        raise ValueError("not 'true' or 'false'")
+
+
+def check_date(value):
+    from feedmark.parser import parse_date
+    parse_date(value)
+
+
+TYPE_CHECKERS = {
+    'text': None,
+    'integer': check_integer,
+    'number': check_number,
+    'boolean': check_boolean,
+    'date': check_date,
+}
+
+
+class PropertyRule(object):
+    """The rule for one property, compiled from the entry for it in a schema.
+    The entry's own properties say what values the property may have:
+
+    *   `optional: true` - entries need not have the property
+    *   `type: text|integer|number|boolean|date` - each value must be of this type
+    *   `date-format: %b %d %Y` - each value must be a date in this format
+    *   `pattern: REGEX` - each value must match the regular expression in full
+    *   `allowed @ VALUE` - each value must be one of these
+    *   `multiple: true|false` - the property must (or must not) be given with `@`
+    *   `min-count: N`, `max-count: N` - bounds on how many values it may have
+    """
+
+    def __init__(self, section):
+        self.key = section.title
+        properties = section.properties
+        self.optional = properties.get('optional', 'false') == 'true'
+
+        type_name = properties.get('type', 'text')
+        if type_name not in TYPE_CHECKERS:
+            raise ValueError("Unknown type '{}' for property '{}' in schema".format(type_name, self.key))
+        self.type_name = type_name
+        self.type_checker = TYPE_CHECKERS[type_name]
+        self.date_format = properties.get('date-format')
+        self.pattern_text = properties.get('pattern')
+        self.pattern = None
+        if self.pattern_text is not None:
+            self.pattern = re.compile(u'(?:{})\\Z'.format(self.pattern_text))
+        self.allowed = None
+        if 'allowed' in properties:
+            allowed = properties['allowed']
+            self.allowed = frozenset(allowed if isinstance(allowed, list) else [allowed])
+        self.multiple = None
+        if 'multiple' in properties:
+            self.multiple = properties['multiple'] == 'true'
+        self.min_count = int(properties['min-count']) if 'min-count' in properties else None
+        self.max_count = int(properties['max-count']) if 'max-count' in properties else None
+
+        self.checks_values = (
+            self.type_checker is not None or self.date_format is not None or self.pattern is not None or
+            self.allowed is not None or self.multiple is not None or
+            self.min_count is not None or self.max_count is not None
+        )
+
+    def check_value(self, value):
+        """Yield a description of each way in which the property's value breaks this rule."""
+        values = value if isinstance(value, list) else [value]
+        if self.multiple is True and not isinstance(value, list):
+            yield "must be given with '@'"
+        elif self.multiple is False and isinstance(value, list):
+            yield "must not be given with '@'"
+        if self.min_count is not None and len(values) < self.min_count:
+            yield "has {} values, fewer than {}".format(len(values), self.min_count)
+        if self.max_count is not None and len(values) > self.max_count:
+            yield "has {} values, more than {}".format(len(values), self.max_count)
+        for v in values:
+            if self.type_checker is not None:
+                try:
+                    self.type_checker(v)
+                except (ValueError, NotImplementedError):
+                    yield u"'{}' is not of type {}".format(v, self.type_name)
+            if self.date_format is not None:
+                try:
+                    datetime.strptime(v, self.date_format)
+                except ValueError:
+                    yield u"'{}' is not a date in the format '{}'".format(v, self.date_format)
+            if self.pattern is not None and not self.pattern.match(v):
+                yield u"'{}' does not match pattern '{}'".format(v, self.pattern_text)
+            if self.allowed is not None and v not in self.allowed:
+                yield u"'{}' is not one of the allowed values".format(v)
 
 
 class Schema(object):
+    """A schema, compiled from a Feedmark document in which each entry
+    describes a property (see `PropertyRule`).  Checking an entry against
+    it reports its extra properties (in the entry's order), then its missing
+    properties (in the schema's order), then any invalid values."""
+
     def __init__(self, document):
         self.document = document
         self.property_rules = {}
@@ -13,50 +134,83 @@ class Schema(object):
             self.property_rules[section.title] = section
             self.property_priority_order.append(section.title)
 
+        rules = [PropertyRule(section) for section in self.document.sections]
+        self.known_keys = frozenset(rule.key for rule in rules)
+        self.required_keys = [rule.key for rule in rules if not rule.optional]
+        self.required_key_set = frozenset(self.required_keys)
+        self.value_rules = dict((rule.key, rule) for rule in rules if rule.checks_values)
+
     def check(self, section):
         results = []
-        for key, value in items(section.properties):
-            if key not in self.property_rules:
-                results.append(['extra', key])
-        for key, value in items(self.property_rules):
-            optional = value.properties.get('optional', 'false') == 'true'
-            if optional:
-                continue
-            if key not in section.properties:
-                results.append(['missing', key])
+        keys = section.properties.keys()
+        if not self.known_keys.issuperset(keys):
+            results.extend(['extra', key] for key in keys if key not in self.known_keys)
+        if not self.required_key_set.issubset(keys):
+            missing = self.required_key_set.difference(keys)
+            results.extend(['missing', key] for key in self.required_keys if key in missing)
+        if self.value_rules:
+            for key, value in items(section.properties):
+                rule = self.value_rules.get(key)
+                if rule is not None:
+                    results.extend(['invalid', key, message] for message in rule.check_value(value))
         return results
 
-    def check_documents(self, documents):
+    def check_documents(self, documents, jobs=1):
+        """Check all of the sections of all of the documents, on `jobs` worker
+        processes, and return all of the results, in document order."""
         results = []
-        for document in documents:
-            for section in document.sections:
-                result = self.check(section)
-                if result:
-                    results.append({
-                        'section': section.title,
-                        'document': document.title,
-                        'result': result
-                    })
+        for document_results in pool_map(partial(check_document, self), documents, jobs=jobs):
+            results.extend(document_results)
         return results
 
     def get_property_priority_order(self):
         return self.property_priority_order
 
 
+def check_document(schema, document):
+    results = []
+    for section in document.sections:
+        result = schema.check(section)
+        if result:
+            results.append({
+                'section': section.title,
+                'document': document.title,
+                'result': result
+            })
+    return results
+
+
+class LinkExtractor(HTMLParser):
+    """Collects the `href` of every `a` element in some HTML, in order.  An
+    `a` element with no `href` contributes None."""
+
+    def __init__(self):
+        HTMLParser.__init__(self)
+        self.links = []
+
+    def handle_starttag(self, tag, attrs):
+        if tag == 'a':
+            self.links.append(dict(attrs).get('href'))
+
+
 def extract_links(html_text):
-    from bs4 import BeautifulSoup
+    extractor = LinkExtractor()
+    extractor.feed(html_text)
+    extractor.close()
+    return extractor.links
 
-    links = []
-    soup = BeautifulSoup(html_text, 'html.parser')
-    for link in soup.find_all('a'):
-        url = link.get('href')
-        links.append(url)
 
-    return links
+def extract_links_from_markdown(markdown_text):
+    # Markdown only produces links from `[...]` syntax, `<...>` autolinks, and raw
+    # HTML, so text containing neither `[` nor `<` need not be converted at all.
+    if '[' not in markdown_text and '<' not in markdown_text:
+        return []
+    return extract_links(markdown_to_html5(markdown_text))
 
 
-def extract_links_from_documents(documents):
-    links = []
+def iter_links_from_document(document, sections):
+    """Yield the links found in the given document, and in the given sections of it.
+    `sections` may be `document.sections`, or a stream of sections from `iter_sections`."""
 
     def make_link(url, section=None, **kwargs):
         link = {
@@ -70,22 +224,32 @@ def extract_links_from_documents(documents):
         link.update(kwargs)
         return link
 
-    def extend_links(section, md):
-        links.extend([make_link(url, section=section) for url in extract_links(markdown_to_html5(md))])
+    def md_links(section, md):
+        return [make_link(url, section=section) for url in extract_links_from_markdown(md)]
+
+    for name, url in document.reference_links:
+        yield make_link(url, name=name)
+    for section in sections:
+        for image in section.images:
+            yield make_link(image['source'], section=section, name=image['description'])
+            if 'link' in image:
+                yield make_link(image['link'], section=section, name=image['description'])
+        for key, value in items(section.properties):
+            if isinstance(value, list):
+                for subitem in value:
+                    for link in md_links(section, subitem):
+                        yield link
+            else:
+                for link in md_links(section, value):
+                    yield link
+        for name, url in section.reference_links:
+            yield make_link(url, section=section, name=name)
+        for link in md_links(section, section.body):
+            yield link
+
 
+def extract_links_from_documents(documents):
+    links = []
     for document in documents:
-        for name, url in document.reference_links:
-            links.append(make_link(url, name=name))
-        for section in document.sections:
-            for (name, url) in section.images:
-                links.append(make_link(url, section=section, name=name))
-            for key, value in items(section.properties):
-                if isinstance(value, list):
-                    for subitem in value:
-                        extend_links(section, subitem)
-                else:
-                    extend_links(section, value)
-            for name, url in section.reference_links:
-                links.append(make_link(url, section=section, name=name))
-            extend_links(section, section.body)
+        links.extend(iter_links_from_document(document, document.sections))
     return links
@@ -1,5 +1,9 @@
 # Feed-related, but Atom-independent, functions.
 
+import heapq
+import posixpath
+
+from feedmark.parser import parse_date
 from feedmark.utils import quote_plus
 
 
@@ -21,10 +25,105 @@ def extract_feed_properties(document):
     return properties
 
 
-def extract_sections(documents):
+def latest_sections(sections, limit=None):
+    """Return the given sections, most recently published first.
+    If `limit` is given, return only that many, without sorting the rest."""
+    if limit:
+        # equivalent to sorting, in reverse, and taking the first `limit` sections
+        return heapq.nlargest(limit, sections, key=lambda section: section.publication_date)
+    sections = list(sections)
+    sections.sort(key=lambda section: section.publication_date, reverse=True)
+    return sections
+
+
+def extract_sections(documents, limit=None):
+    """Return the sections of the documents, most recently published first.
+    If `limit` is given, return only that many, without sorting the rest."""
     sections = []
     for document in documents:
         for section in document.sections:
             sections.append(section)
-    sections.sort(key=lambda section: section.publication_date, reverse=True)
-    return sections
+    return latest_sections(sections, limit=limit)
+
+
+def as_list(value):
+    if value is None:
+        return []
+    return value if isinstance(value, list) else [value]
+
+
+class FeedSpec(object):
+    """One of the feeds described by a feed-spec document (`--feed-spec`), in
+    which each entry is a feed, titled with the entry's title.  The entry's
+    properties say which entries of the input documents it contains:
+
+    *   `output: FILENAME` - write the feed to this file (required)
+    *   `document @ FILENAME` - only entries of these documents (given by
+        filename or by title); by default, entries of all the documents
+    *   `where @ CONDITION` - only entries meeting these conditions, as
+        with `--where`
+    *   `since: DATE`, `until: DATE` - only entries published in this range
+        (inclusive), with dates in the same format as the entries' dates
+    *   `limit: N` - only the N most recently published of those entries
+    *   `author: NAME`, `url: URL` - use these instead of the documents' own
+    """
+
+    def __init__(self, section):
+        from feedmark.index import Condition
+
+        self.title = section.title
+        properties = section.properties
+        if 'output' not in properties:
+            raise ValueError("Feed '{}' in feed spec has no output".format(self.title))
+        self.output = properties['output']
+        self.documents = frozenset(as_list(properties.get('document')))
+        self.conditions = [Condition(text) for text in as_list(properties.get('where'))]
+        self.since = parse_date(properties['since']) if 'since' in properties else None
+        self.until = parse_date(properties['until']) if 'until' in properties else None
+        self.limit = int(properties['limit']) if 'limit' in properties else None
+        self.overrides = dict(
+            (key, properties[key]) for key in ('author', 'url') if key in properties
+        )
+
+    def selects_document(self, document):
+        return not self.documents or bool(self.documents.intersection(
+            (document.title, document.filename, posixpath.normpath(document.filename or ''))
+        ))
+
+    def selects_section(self, section):
+        if not all(condition.matches(section) for condition in self.conditions):
+            return False
+        if self.since is not None and section.publication_date < self.since:
+            return False
+        if self.until is not None and section.publication_date > self.until:
+            return False
+        return True
+
+    def select(self, documents):
+        """Return the documents this feed draws from, and the sections it
+        contains, most recently published first."""
+        documents = [document for document in documents if self.selects_document(document)]
+        sections = [
+            section for document in documents for section in document.sections
+            if self.selects_section(section)
+        ]
+        return (documents, latest_sections(sections, limit=self.limit))
+
+    def feed_properties(self, documents):
+        properties = {'title': self.title}
+        properties.update(self.overrides)
+        for key in ('author', 'url'):
+            if key in properties:
+                continue
+            # as with --output-atom, the last document's value is used
+            for document in documents:
+                if key in document.properties:
+                    properties[key] = document.properties[key]
+            if key not in properties:
+                raise ValueError("Feed '{}' in feed spec has no {}, and neither do its documents".format(self.title, key))
+        return properties
+
+
+def read_feed_specs(document):
+    """Return the FeedSpecs described by the given feed-spec document."""
+    return [FeedSpec(section) for section in document.sections]
@@ -1,19 +1,23 @@
 from __future__ import absolute_import
 
 from datetime import datetime
+from io import BytesIO
 
 import atomize
 
 from feedmark.feeds import extract_feed_properties, extract_sections, construct_entry_url
 from feedmark.formats.markdown import markdown_to_html5
+from feedmark.utils import pool_imap, replacing_file
 
 
-def convert_section_to_entry(section, properties, markdown_links_base=None):
+def convert_section_to_entry(section, properties, markdown_links_base=None, summary_html=None):
 
     guid = properties['url'] + "/" + section.title
     updated = section.publication_date
 
-    summary = atomize.Summary(markdown_to_html5(section.body), content_type='html')
+    if summary_html is None:
+        summary_html = markdown_to_html5(section.body)
+    summary = atomize.Summary(summary_html, content_type='html')
 
     links = []
     entry_url = construct_entry_url(section)
@@ -29,29 +33,85 @@ def convert_section_to_entry(section, properties, markdown_links_base=None):
     )
 
 
-def feedmark_atomize(documents, out_filename, limit=None):
-    properties = {}
+def serialize_entry(entry):
+    parent = atomize.ET.Element('feed')
+    entry.publish(parent)
+    return atomize.ET.tostring(parent[0], encoding='utf-8')
 
-    for document in documents:
-        these_properties = extract_feed_properties(document)
-        properties.update(these_properties)  # TODO: something more elegant than this
 
-    entries = []
-    for section in extract_sections(documents):
-        entries.append(convert_section_to_entry(section, properties))
+def write_feed(f, feed, entries):
+    """Write the given atomize Feed, which should have no entries of its own,
+    to the binary file `f`, followed by the given entries, one at a time.
+    The result is the same as if the entries had been given to the Feed."""
+    out = BytesIO()
+    feed.publish().write(out, xml_declaration=True, encoding='utf-8')
+    text = out.getvalue()
+    end = text.rindex(b'</feed>')
+    f.write(text[:end])
+    for entry in entries:
+        f.write(serialize_entry(entry))
+    f.write(text[end:])
 
-    if limit and len(entries) > limit:
-        entries = entries[:limit]
 
+def make_feed(properties):
     assert properties['author'], "Need author"
 
-    feed = atomize.Feed(
+    return atomize.Feed(
         author=properties['author'],
         title=properties['title'],
         updated=datetime.utcnow(),
         guid=properties['url'],
         self_link=properties['url'],
-        entries=entries
+        entries=[]
     )
 
-    feed.write_file(out_filename)
+
+def feedmark_atomize(documents, out_filename, limit=None, jobs=1):
+    properties = {}
+
+    for document in documents:
+        these_properties = extract_feed_properties(document)
+        properties.update(these_properties)  # TODO: something more elegant than this
+
+    feed = make_feed(properties)
+
+    # Summaries are rendered (on a pool of `jobs` workers) and written out as
+    # they are needed, so that the feed is never all in memory at once.
+    sections = extract_sections(documents, limit=limit)
+    summaries = pool_imap(markdown_to_html5, (section.body for section in sections), jobs=jobs)
+    entries = (
+        convert_section_to_entry(section, properties, summary_html=summary_html)
+        for (section, summary_html) in zip(sections, summaries)
+    )
+    with replacing_file(out_filename) as f:
+        write_feed(f, feed, entries)
+
+
+def feedmark_atomize_feeds(documents, specs, jobs=1):
+    """Write each of the feeds described by the given FeedSpecs.  The summary
+    of each entry is rendered only once, however many feeds it appears in."""
+    selections = []
+    for spec in specs:
+        (spec_documents, sections) = spec.select(documents)
+        if not spec_documents:
+            raise ValueError("Feed '{}' in feed spec selects no documents".format(spec.title))
+        selections.append((spec, spec.feed_properties(spec_documents), sections))
+
+    summaries = {}
+    pending = []
+    for (spec, properties, sections) in selections:
+        for section in sections:
+            if id(section) not in summaries:
+                summaries[id(section)] = None
+                pending.append(section)
+    rendered = pool_imap(markdown_to_html5, (section.body for section in pending), jobs=jobs)
+    for (section, summary_html) in zip(pending, rendered):
+        summaries[id(section)] = summary_html
+
+    for (spec, properties, sections) in selections:
+        entries = (
+            convert_section_to_entry(section, properties, summary_html=summaries[id(section)])
+            for section in sections
+        )
+        with replacing_file(spec.output) as f:
+            write_feed(f, make_feed(properties), entries)
@@ -1,9 +1,14 @@
 from __future__ import absolute_import
 
 from collections import OrderedDict
+from functools import partial
+from hashlib import sha1
+import codecs
+import json
 import re
+import threading
 
-from feedmark.utils import items_in_priority_order, unicode
+from feedmark.utils import items_in_priority_order, pool_map, unicode
 
 
 def remove_outer_p(html):
@@ -13,82 +18,287 @@ def remove_outer_p(html):
     return html
 
 
+# Building a Markdown converter, with its extensions, is costly compared to
+# converting a small snippet of text, so each thread keeps one around and
+# resets it before each conversion.
+converters = threading.local()
+
+
+def convert_markdown(text, references=None):
+    """Convert Markdown text to HTML with this thread's converter.  `references`,
+    if given, is a dict of already-parsed reference link definitions, such as is
+    returned by `ReferenceLinks.references`, to make available to the text."""
+    converter = getattr(converters, 'converter', None)
+    if converter is None:
+        from markdown import Markdown
+        converter = Markdown(extensions=['markdown.extensions.toc'])
+        converters.converter = converter
+    converter.reset()
+    if references:
+        converter.references.update(references)
+    return converter.convert(text)
+
+
+class ReferenceLinks(object):
+    """Reference links to be made available to many snippets of Markdown text.
+
+    Rather than appending the definitions to every snippet, and having
+    Markdown parse them again each time, they are parsed once and handed
+    to the converter directly.  Snippets which could interact with the
+    appended definitions (because they contain definitions of their own,
+    or raw HTML blocks) still have them appended."""
+
+    INTERACTING_RE = re.compile(r'\]\:|^\s*\<', re.MULTILINE)
+
+    def __init__(self, reference_links):
+        self.markdown = markdownize_reference_links(reference_links)
+        self.digest = sha1(self.markdown.encode('utf-8')).hexdigest()
+        self.parsed = None
+
+    def references(self):
+        if self.parsed is None:
+            convert_markdown(self.markdown)
+            self.parsed = dict(converters.converter.references)
+        return self.parsed
+
+    def convert(self, text):
+        if not self.markdown:
+            return convert_markdown(text)
+        if self.INTERACTING_RE.search(text):
+            return convert_markdown(text + self.markdown)
+        return convert_markdown(text, references=self.references())
+
+
+class FragmentCache(object):
+    """A bounded, least-recently-used cache of the HTML that small fragments of
+    Markdown, such as property values, convert to.  Entries are keyed on the text
+    of the fragment and the digest of the reference links it was converted with,
+    so the cache can be shared between documents, and saved between runs."""
+
+    def __init__(self, maxsize=10000):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        try:
+            html = self.entries.pop(key)
+        except KeyError:
+            self.misses += 1
+            return None
+        self.entries[key] = html
+        self.hits += 1
+        return html
+
+    def put(self, key, html):
+        self.entries.pop(key, None)
+        self.entries[key] = html
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        self.entries.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def load(self, filename):
+        with codecs.open(filename, 'r', encoding='utf-8') as f:
+            for (text, digest, html) in json.loads(f.read()):
+                self.put((text, digest), html)
+
+    def save(self, filename):
+        data = [[text, digest, html] for ((text, digest), html) in self.entries.items()]
+        with codecs.open(filename, 'w', encoding='utf-8') as f:
+            f.write(json.dumps(data))
+
+
+fragment_cache = FragmentCache()
+
+
 def markdown_to_html5(text, reference_links=None):
-    """Canonical function used within `feedmark` to convert Markdown text to a HTML5 snippet."""
-    from markdown import markdown
+    """Canonical function used within `feedmark` to convert Markdown text to a HTML5 snippet.
+    `reference_links` may be a list of (name, url) pairs or a `ReferenceLinks` object."""
+    if not isinstance(reference_links, ReferenceLinks):
+        reference_links = ReferenceLinks(reference_links)
 
-    if reference_links:
-        text += markdownize_reference_links(reference_links)
+    return reference_links.convert(text)
 
-    return markdown(text, extensions=['markdown.extensions.toc'])
 
+def markdown_to_html5_deep(obj, reference_links=None):
+    if not isinstance(reference_links, ReferenceLinks):
+        reference_links = ReferenceLinks(reference_links)
 
-def markdown_to_html5_deep(obj, **kwargs):
-    if obj is None:
-        return None
-    elif isinstance(obj, OrderedDict):
-        return OrderedDict((k, markdown_to_html5_deep(v, **kwargs)) for k, v in obj.items())
-    elif isinstance(obj, dict):
-        return dict((k, markdown_to_html5_deep(v, **kwargs)) for k, v in obj.items())
-    elif isinstance(obj, list):
-        return [markdown_to_html5_deep(subobj, **kwargs) for subobj in obj]
-    else:
-        return remove_outer_p(markdown_to_html5(unicode(obj), **kwargs))
+    def convert(obj):
+        if obj is None:
+            return None
+        elif isinstance(obj, OrderedDict):
+            return OrderedDict((k, convert(v)) for k, v in obj.items())
+        elif isinstance(obj, dict):
+            return dict((k, convert(v)) for k, v in obj.items())
+        elif isinstance(obj, list):
+            return [convert(subobj) for subobj in obj]
+        else:
+            text = unicode(obj)
+            key = (text, reference_links.digest)
+            html = fragment_cache.get(key)
+            if html is None:
+                html = remove_outer_p(reference_links.convert(text))
+                fragment_cache.put(key, html)
+            return html
 
+    return convert(obj)
 
-def markdownize_properties(properties, property_priority_order):
+
+def iter_markdown_properties(properties, property_priority_order):
     if not properties:
-        return ''
-    md = ''
+        return
     for key, value in items_in_priority_order(properties, property_priority_order):
         if isinstance(value, list):
             for subitem in value:
-                md += u'*   {} @ {}\n'.format(key, subitem)
+                yield u'*   {} @ {}\n'.format(key, subitem)
         else:
-            md += u'*   {}: {}\n'.format(key, value)
-    md += '\n'
-    return md
+            yield u'*   {}: {}\n'.format(key, value)
+    yield u'\n'
 
 
-def markdownize_reference_links(reference_links):
+def markdownize_properties(properties, property_priority_order):
+    return u''.join(iter_markdown_properties(properties, property_priority_order))
+
+
+def iter_markdown_reference_links(reference_links):
     if not reference_links:
-        return u''
-    md = u''
-    md += u'\n'
+        return
+    yield u'\n'
     for name, url in reference_links:
-        md += u'[{}]: {}\n'.format(name, url)
-    return md
+        yield u'[{}]: {}\n'.format(name, url)
+
+
+def markdownize_reference_links(reference_links):
+    return u''.join(iter_markdown_reference_links(reference_links))
+
+
+def iter_markdown_header(document, property_priority_order, reference_links=True):
+    yield u'{}\n{}\n\n'.format(document.title, '=' * len(document.title))
+    for chunk in iter_markdown_properties(document.properties, property_priority_order):
+        yield chunk
+    yield document.preamble
+    if reference_links:
+        for chunk in iter_markdown_reference_links(document.reference_links):
+            yield chunk
+
+
+def iter_markdown_section(section, property_priority_order, reference_links=True):
+    yield u'\n### {}\n\n'.format(section.title)
+    if section.images:
+        for entry in section.images:
+            if 'link' in entry:
+                yield u'[![{}]({})]({})\n'.format(
+                    entry['description'], entry['source'], entry['link'],
+                )
+            else:
+                yield u'![{}]({})\n'.format(
+                    entry['description'], entry['source'],
+                )
+        yield u'\n'
+    for chunk in iter_markdown_properties(section.properties, property_priority_order):
+        yield chunk
+    yield section.body
+    if reference_links:
+        for chunk in iter_markdown_reference_links(section.reference_links):
+            yield chunk
+
+
+def get_property_priority_order(schema):
+    if schema is None:
+        return []
+    return schema.get_property_priority_order()
+
+
+def iter_markdown(document, schema=None):
+    """Yield the Markdown text of a Feedmark document, in chunks, so that it
+    can be written out without first being assembled into one string."""
+    property_priority_order = get_property_priority_order(schema)
+
+    for chunk in iter_markdown_header(document, property_priority_order):
+        yield chunk
+    for section in document.sections:
+        for chunk in iter_markdown_section(section, property_priority_order):
+            yield chunk
+    yield u'\n'
+
+
+def write_markdown(document, f, schema=None):
+    for chunk in iter_markdown(document, schema=schema):
+        f.write(chunk)
 
 
 def feedmark_markdownize(document, schema=None):
-    property_priority_order = []
-    if schema is not None:
-        property_priority_order = schema.get_property_priority_order()
-
-    md = u'{}\n{}\n\n'.format(document.title, '=' * len(document.title))
-    md += markdownize_properties(document.properties, property_priority_order)
-    md += document.preamble
-    md += markdownize_reference_links(document.reference_links)
+    return u''.join(iter_markdown(document, schema=schema))
+
+
+# HTML which the Markdown for a document's header, or for one of its sections,
+# converts to, keyed like `fragment_cache`.
+section_cache = FragmentCache(maxsize=10000)
+
+# Markdown which could make the HTML of a document's sections depend on each
+# other: a table of contents marker, or a line beginning a raw HTML block
+# (which could be left unclosed until a later section.)
+SECTION_INTERACTING_RE = re.compile(r'\[TOC\]|^\s*\<', re.MULTILINE)
+HTML_ID_RE = re.compile(r'\sid="([^"]*)"')
+
+
+def htmlize_section_markdown(text, reference_links=None):
+    key = (text, reference_links.digest)
+    html = section_cache.get(key)
+    if html is None:
+        html = reference_links.convert(text)
+        section_cache.put(key, html)
+    return html
+
+
+def iter_html(document, schema=None, jobs=1):
+    """Yield the HTML5 of a Feedmark document, in chunks.
+
+    The header of the document (title, properties and preamble) and each of
+    its sections are converted separately, sharing all of the document's
+    reference links, and on `jobs` worker processes if `jobs` is more than 1.
+    The result is the same as converting the whole document at once.  If it
+    could not be (the sections contain Markdown that could interact, or the
+    `toc` extension would have to disambiguate heading ids across sections),
+    the whole document is converted at once instead."""
+    property_priority_order = get_property_priority_order(schema)
+    texts = [u''.join(iter_markdown_header(document, property_priority_order, reference_links=False))]
     for section in document.sections:
-        md += u'\n'
-        md += u'### {}\n\n'.format(section.title)
-        if section.images:
-            for entry in section.images:
-                if 'link' in entry:
-                    md += u'[![{}]({})]({})\n'.format(
-                        entry['description'], entry['source'], entry['link'],
-                    )
-                else:
-                    md += u'![{}]({})\n'.format(
-                        entry['description'], entry['source'],
-                    )
-            md += u'\n'
-        md += markdownize_properties(section.properties, property_priority_order)
-        md += section.body
-        md += markdownize_reference_links(section.reference_links)
-    md += '\n'
-    return md
-
-
-def feedmark_htmlize(document, *args, **kwargs):
+        texts.append(u''.join(iter_markdown_section(section, property_priority_order, reference_links=False)))
+
+    htmls = None
+    if not any(SECTION_INTERACTING_RE.search(text) for text in texts):
+        reference_links = ReferenceLinks(document.global_reference_links())
+        htmls = [html for html in pool_map(
+            partial(htmlize_section_markdown, reference_links=reference_links), texts, jobs=jobs
+        ) if html]
+        ids = [id for html in htmls for id in HTML_ID_RE.findall(html)]
+        if len(set(ids)) != len(ids):
+            htmls = None
+
+    if htmls is None:
+        yield feedmark_htmlize_whole(document, schema=schema)
+        return
+    for (n, html) in enumerate(htmls):
+        if n > 0:
+            yield u'\n'
+        yield html
+
+
+def write_html(document, f, schema=None, jobs=1):
+    for chunk in iter_html(document, schema=schema, jobs=jobs):
+        f.write(chunk)
+
+
+def feedmark_htmlize(document, schema=None, jobs=1):
+    return u''.join(iter_html(document, schema=schema, jobs=jobs))
+
+
+def feedmark_htmlize_whole(document, *args, **kwargs):
     return markdown_to_html5(feedmark_markdownize(document, *args, **kwargs))
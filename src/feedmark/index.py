@@ -0,0 +1,150 @@
+# An inverted index of the properties of the entries of a set of documents,
+# for selecting entries by property value (`--where`) without looking at
+# every property of every entry.
+
+import codecs
+import json
+import os
+import re
+
+from feedmark.utils import items, write_file_if_changed
+from feedmark.watch import stamp_of
+
+
+class Condition(object):
+    """A condition on one property of an entry, parsed from `key=value`
+    (the value is exactly `value`), `key^=value` (the value starts with
+    `value`), or `key~=value` (the value matches the regular expression
+    `value`).  An entry whose property has multiple values (`key @ value`)
+    meets the condition if any of its values do."""
+
+    def __init__(self, text):
+        if '=' not in text:
+            raise ValueError("Condition must be of the form key=value, key^=value or key~=value: {}".format(text))
+        (key, value) = text.split('=', 1)
+        self.operator = '='
+        if key.endswith(('^', '~')):
+            self.operator = key[-1] + '='
+            key = key[:-1]
+        self.key = key.strip()
+        self.value = value.strip()
+        if self.operator == '~=':
+            try:
+                self.pattern = re.compile(self.value)
+            except re.error as e:
+                raise ValueError("Invalid regular expression {!r}: {}".format(self.value, e))
+
+    def __repr__(self):
+        return 'Condition({!r})'.format(u'{}{}{}'.format(self.key, self.operator, self.value))
+
+    def matches_value(self, value):
+        if self.operator == '=':
+            return value == self.value
+        elif self.operator == '^=':
+            return value.startswith(self.value)
+        else:
+            return self.pattern.search(value) is not None
+
+    def matches(self, section):
+        value = section.properties.get(self.key)
+        if value is None:
+            return False
+        if isinstance(value, list):
+            return any(self.matches_value(v) for v in value)
+        return self.matches_value(value)
+
+    def select(self, by_value):
+        """Given the `value -> positions` mapping for this condition's key in a
+        document's index, return the set of positions of entries which meet it."""
+        if self.operator == '=':
+            return set(by_value.get(self.value, ()))
+        positions = set()
+        for (value, value_positions) in items(by_value):
+            if self.matches_value(value):
+                positions.update(value_positions)
+        return positions
+
+
+def index_document(document):
+    """Return the inverted index of the properties of the sections of the
+    given document: key -> value -> positions (in `document.sections`) of the
+    sections which have it.  Positions, not titles, identify the sections,
+    as two sections of a document may have the same title."""
+    index = {}
+    for (position, section) in enumerate(document.sections):
+        for (key, value) in items(section.properties):
+            by_value = index.setdefault(key, {})
+            for v in (value if isinstance(value, list) else [value]):
+                positions = by_value.setdefault(v, [])
+                if not positions or positions[-1] != position:
+                    positions.append(position)
+    return index
+
+
+class PropertyIndex(object):
+    """Inverted property indexes of a set of documents, each one recorded
+    along with the size and modification time its file had when indexed,
+    so that a saved index can be re-used for as long as the files are
+    unchanged, and documents with no matching entries need not be read."""
+
+    VERSION = 2
+
+    def __init__(self):
+        self.documents = {}
+        # Documents which have been indexed by this instance; not saved.
+        self.sources = {}
+
+    def add(self, document):
+        key = os.path.abspath(document.filename)
+        self.documents[key] = (stamp_of(document.filename), index_document(document))
+        self.sources[key] = document
+
+    def is_fresh(self, filename):
+        entry = self.documents.get(os.path.abspath(filename))
+        return entry is not None and entry[0] == stamp_of(filename)
+
+    def matching_positions(self, filename, conditions):
+        """Return the set of positions of the entries in the indexed document
+        read from `filename` which meet all of the given conditions."""
+        (stamp, index) = self.documents[os.path.abspath(filename)]
+        positions = None
+        for condition in conditions:
+            selected = condition.select(index.get(condition.key, {}))
+            positions = selected if positions is None else (positions & selected)
+            if not positions:
+                break
+        return positions or set()
+
+    def update(self, documents):
+        """Index any of the given documents which have not been indexed yet."""
+        for document in documents:
+            if self.sources.get(os.path.abspath(document.filename)) is not document:
+                self.add(document)
+
+    def select_documents(self, documents, conditions):
+        """Return copies of those of the given documents which have entries
+        meeting all of the conditions, containing only those entries."""
+        self.update(documents)
+        selected = []
+        for document in documents:
+            positions = self.matching_positions(document.filename, conditions)
+            if positions:
+                copy = document.copy()
+                copy.sections = [document.sections[position] for position in sorted(positions)]
+                selected.append(copy)
+        return selected
+
+    def load(self, filename):
+        with codecs.open(filename, 'r', encoding='utf-8') as f:
+            data = json.loads(f.read())
+        if data.get('version') != self.VERSION:
+            return
+        for (key, (stamp, index)) in items(data['documents']):
+            self.documents[key] = (tuple(stamp) if stamp is not None else None, index)
+
+    def save(self, filename):
+        data = {
+            'version': self.VERSION,
+            'documents': dict((key, [stamp, index]) for (key, (stamp, index)) in items(self.documents)),
+        }
+        write_file_if_changed(filename, json.dumps(data, sort_keys=True))
@@ -0,0 +1,263 @@
+# Checking the links found by `--output-links`: external links are requested
+# (once per distinct URL, concurrently, with a limited number of connections
+# to, and rate of requests to, each host) and internal links to `filename#anchor`
+# are checked against the documents and the refdex.  Requires Python 3.7.
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import codecs
+import http.client
+import json
+import os
+import posixpath
+import time
+from urllib.parse import unquote, urlsplit
+
+from feedmark.utils import items, write_file_if_changed
+
+
+class LinkCache(object):
+    """Results of checking external links, saved to a JSON file and re-used
+    for `ttl` seconds after each link was checked."""
+
+    def __init__(self, filename=None, ttl=86400):
+        self.filename = filename
+        self.ttl = ttl
+        self.results = {}
+        if filename is not None and os.path.exists(filename):
+            with codecs.open(filename, 'r', encoding='utf-8') as f:
+                self.results = json.loads(f.read())
+
+    def get(self, url):
+        result = self.results.get(url)
+        if result is not None and time.time() - result['checked'] < self.ttl:
+            return result
+        return None
+
+    def put(self, url, result):
+        self.results[url] = result
+
+    def save(self):
+        if self.filename is not None:
+            now = time.time()
+            results = dict(
+                (url, result) for (url, result) in items(self.results) if now - result['checked'] < self.ttl
+            )
+            write_file_if_changed(self.filename, json.dumps(results, indent=4, sort_keys=True))
+
+
+class Host(object):
+    """Connections to, and the schedule of requests to, one host."""
+
+    def __init__(self, scheme, netloc, connections, rate):
+        self.scheme = scheme
+        self.netloc = netloc
+        self.semaphore = asyncio.Semaphore(connections)
+        self.interval = 1.0 / rate if rate else 0.0
+        self.next_start = 0.0
+        self.idle = []
+
+    async def wait_turn(self):
+        now = time.time()
+        start = max(now, self.next_start)
+        self.next_start = start + self.interval
+        if start > now:
+            await asyncio.sleep(start - now)
+
+    def connect(self, timeout, reuse=True):
+        """Return a connection to the host, and whether it was re-used from the
+        idle connections (in which case the server may have closed it.)"""
+        if reuse:
+            # several worker threads may share this host, so another may
+            # have taken the last idle connection since we last looked
+            try:
+                return (self.idle.pop(), True)
+            except IndexError:
+                pass
+        if self.scheme == 'https':
+            return (http.client.HTTPSConnection(self.netloc, timeout=timeout), False)
+        return (http.client.HTTPConnection(self.netloc, timeout=timeout), False)
+
+
+# Errors which, on a re-used keep-alive connection, mean only that the server
+# had already closed it, so the request is worth retrying on a new connection.
+STALE_CONNECTION_ERRORS = (http.client.RemoteDisconnected, BrokenPipeError, ConnectionResetError)
+
+
+def request_once(host, method, path, timeout):
+    (conn, reused) = host.connect(timeout)
+    while True:
+        try:
+            conn.request(method, path, headers={'User-Agent': 'feedmark'})
+            response = conn.getresponse()
+            response.read()
+            return (conn, response)
+        except STALE_CONNECTION_ERRORS:
+            conn.close()
+            if not reused:
+                raise
+            (conn, reused) = host.connect(timeout, reuse=False)
+        except Exception:
+            conn.close()
+            raise
+
+
+def request(host, url, timeout):
+    """Make a HEAD request (or a GET, if HEAD is not allowed) for `url` on a
+    pooled connection to `host`.  Runs in a worker thread."""
+    parts = urlsplit(url)
+    path = parts.path or '/'
+    if parts.query:
+        path += '?' + parts.query
+    status = None
+    for method in ('HEAD', 'GET'):
+        (conn, response) = request_once(host, method, path, timeout)
+        status = response.status
+        if response.will_close:
+            conn.close()
+        else:
+            host.idle.append(conn)
+        if status not in (405, 501):
+            break
+    return status
+
+
+class LinkChecker(object):
+    """Checks external links, with at most `connections` requests in flight to
+    any one host, and at most `workers` requests in flight altogether."""
+
+    def __init__(self, cache=None, connections=4, rate=None, timeout=10.0, workers=16):
+        self.cache = cache if cache is not None else LinkCache()
+        self.connections = connections
+        self.workers = workers
+        self.rate = rate
+        self.timeout = timeout
+        self.hosts = {}
+
+    def host_for(self, url):
+        parts = urlsplit(url)
+        key = (parts.scheme, parts.netloc)
+        if key not in self.hosts:
+            self.hosts[key] = Host(parts.scheme, parts.netloc, self.connections, self.rate)
+        return self.hosts[key]
+
+    async def check(self, url, executor):
+        host = self.host_for(url)
+        async with host.semaphore:
+            async with self.semaphore:
+                await host.wait_turn()
+                loop = asyncio.get_running_loop()
+                try:
+                    status = await loop.run_in_executor(executor, request, host, url, self.timeout)
+                    error = None if status < 400 else 'HTTP status {}'.format(status)
+                except Exception as e:
+                    (status, error) = (None, '{}: {}'.format(e.__class__.__name__, e))
+        result = {'checked': time.time(), 'status': status, 'error': error}
+        self.cache.put(url, result)
+        return result
+
+    async def check_all(self, urls):
+        # Hosts (and their semaphores) belong to the event loop they are used in.
+        self.hosts = {}
+        self.semaphore = asyncio.Semaphore(self.workers)
+        executor = ThreadPoolExecutor(max_workers=max(1, self.workers))
+        try:
+            results = await asyncio.gather(*[self.check(url, executor) for url in urls])
+        finally:
+            executor.shutdown(wait=True)
+            for host in self.hosts.values():
+                for conn in host.idle:
+                    conn.close()
+                host.idle = []
+        return dict(zip(urls, results))
+
+    def check_urls(self, urls):
+        """Check each of the given external URLs (once, however many times it is
+        given) that does not have a fresh result in the cache, and return a dict
+        mapping each URL to its result: `status` and `error` (None if it is OK.)"""
+        results = {}
+        unchecked = []
+        for url in urls:
+            if url in results:
+                continue
+            result = self.cache.get(url)
+            results[url] = result
+            if result is None:
+                unchecked.append(url)
+        if unchecked:
+            results.update(asyncio.run(self.check_all(unchecked)))
+        return results
+
+
+def is_external(url):
+    return urlsplit(url).scheme in ('http', 'https')
+
+
+def is_internal(url):
+    parts = urlsplit(url)
+    return not parts.scheme and not parts.netloc
+
+
+class InternalLinks(object):
+    """Resolves internal `filename#anchor` links against the anchors of the
+    sections of the given documents, and of the entries of the refdex."""
+
+    def __init__(self, documents, refdex=None):
+        self.anchors = {}
+        for document in documents:
+            self.anchors.setdefault(posixpath.normpath(document.filename), set()).update(
+                section.anchor for section in document.sections
+            )
+        self.refdex_anchors = {}
+        for (name, entry) in items(refdex or {}):
+            if 'anchor' in entry:
+                for filename in entry.get('filenames') or [entry.get('filename')]:
+                    self.refdex_anchors.setdefault(posixpath.normpath(filename), set()).add(entry['anchor'])
+
+    def check(self, url, document_filename=None):
+        """Return None if the internal link is good, or a description of the problem."""
+        parts = urlsplit(url)
+        path = unquote(parts.path)
+        anchor = unquote(parts.fragment)
+        if not path:
+            if document_filename is None:
+                return None
+            path = document_filename
+        candidates = [posixpath.normpath(path)]
+        if document_filename is not None:
+            candidates.append(posixpath.normpath(posixpath.join(posixpath.dirname(document_filename), path)))
+        for filename in candidates:
+            if filename in self.anchors:
+                if anchor and anchor not in self.anchors[filename]:
+                    return "No entry with anchor '{}' in '{}'".format(anchor, filename)
+                return None
+        for filename in candidates:
+            if anchor and anchor in self.refdex_anchors.get(filename, ()):
+                return None
+        for filename in candidates:
+            if os.path.exists(filename):
+                return None
+        return "No such file '{}'".format(path)
+
+
+def check_links(links, documents, refdex=None, checker=None):
+    """Check the given link records (from `extract_links_from_documents`) and
+    return those which are broken, each with an `error` added."""
+    checker = checker if checker is not None else LinkChecker()
+    internal = InternalLinks(documents, refdex=refdex)
+    filenames = dict((document.title, document.filename) for document in documents)
+
+    results = checker.check_urls([link['url'] for link in links if link['url'] and is_external(link['url'])])
+    broken = []
+    for link in links:
+        url = link['url']
+        error = None
+        if not url:
+            error = "Link has no URL"
+        elif is_external(url):
+            error = results[url]['error']
+        elif is_internal(url):
+            error = internal.check(url, document_filename=filenames.get(link.get('document')))
+        if error is not None:
+            broken.append(dict(link, error=error))
+    return broken
@@ -1,69 +1,159 @@
 import codecs
+import io
 import json
+import os
 import sys
 
-from feedmark.parser import Parser
+from feedmark.parser import Parser, iter_sections
 from feedmark.utils import items
 
 
-def read_document_from(filename):
+class DocumentCache(object):
+    """On-disk cache of parsed Documents, one pickle file per input file.
+
+    Entries are keyed on the absolute path of the input file, plus its
+    size and modification time, so a warm lookup costs one `stat` of the
+    input file and one read of the pickle.  If `size_limit` (in bytes) is
+    given, `evict` removes the least recently used entries until the
+    cache fits within it."""
+
+    # Bump this whenever a change to the parser or to Document or Section
+    # means that previously pickled documents are no longer valid.
+    VERSION = 3
+
+    def __init__(self, directory, size_limit=None):
+        self.directory = directory
+        self.size_limit = size_limit
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def path_for(self, filename):
+        from hashlib import sha1
+
+        st = os.stat(filename)
+        mtime = getattr(st, 'st_mtime_ns', st.st_mtime)
+        key = repr((self.VERSION, os.path.abspath(filename), st.st_size, mtime))
+        return os.path.join(self.directory, sha1(key.encode('utf-8')).hexdigest() + '.pickle')
+
+    def get(self, filename, path=None):
+        import pickle
+
+        path = path if path is not None else self.path_for(filename)
+        try:
+            with open(path, 'rb') as f:
+                document = pickle.load(f)
+        except Exception:
+            return None
+        os.utime(path, None)
+        document.filename = filename
+        return document
+
+    def put(self, filename, document, path=None):
+        """Store the document parsed from the file.  `path` should be what
+        `path_for` returned before the file was read; if it is not given, the
+        file is assumed not to have changed since it was read."""
+        import pickle
+        import tempfile
+
+        path = path if path is not None else self.path_for(filename)
+        (fd, temp_path) = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump(document, f, pickle.HIGHEST_PROTOCOL)
+        os.rename(temp_path, path)
+
+    def entries(self):
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith('.pickle'):
+                path = os.path.join(self.directory, name)
+                st = os.stat(path)
+                entries.append((st.st_mtime, st.st_size, path))
+        return entries
+
+    def evict(self):
+        if self.size_limit is None:
+            return
+        entries = sorted(self.entries())
+        total = sum(size for (mtime, size, path) in entries)
+        for (mtime, size, path) in entries:
+            if total <= self.size_limit:
+                break
+            os.unlink(path)
+            total -= size
+
+    def clear(self):
+        for (mtime, size, path) in self.entries():
+            os.unlink(path)
+
+
+def read_document_from(filename, cache=None):
+    if cache is not None:
+        # the key is taken before the file is read, so that if the file
+        # changes while it is being parsed, the parse is not stored under
+        # the key of the changed file
+        path = cache.path_for(filename)
+        document = cache.get(filename, path=path)
+        if document is not None:
+            return document
     with codecs.open(filename, 'r', encoding='utf-8') as f:
         markdown_text = f.read()
     parser = Parser(markdown_text)
     document = parser.parse_document()
     document.filename = filename
+    if cache is not None and cache.path_for(filename) == path:
+        cache.put(filename, document, path=path)
     return document
 
 
+def iter_sections_from(filename):
+    """Read a document incrementally; see `feedmark.parser.iter_sections`."""
+    with io.open(filename, 'r', encoding='utf-8', newline='\n') as f:
+        stream = iter_sections(f)
+        document = next(stream)
+        document.filename = filename
+        yield document
+        for section in stream:
+            yield section
+
+
 def read_refdex_from(filenames, input_refdex_filename_prefix=None):
+    """Read and merge the given refdexes.  If any of them is a compiled
+    refdex (see `feedmark.refdex`), the result is a `LayeredRefdex` which
+    reads entries lazily, rather than a dict."""
+    from feedmark.refdex import (
+        CompiledRefdex, LayeredRefdex, check_refdex_entry, is_compiled_refdex, prefix_refdex_entry,
+    )
+
+    def check(refdex):
+        for key, value in items(refdex):
+            check_refdex_entry(key, value)
+        return refdex
+
+    layers = []
     refdex = {}
     for filename in filenames:
+        if is_compiled_refdex(filename):
+            if refdex:
+                layers.append(check(refdex))
+                refdex = {}
+            layers.append(CompiledRefdex(filename, filename_prefix=input_refdex_filename_prefix))
+            continue
         try:
             with codecs.open(filename, 'r', encoding='utf-8') as f:
                 local_refdex = json.loads(f.read())
                 if input_refdex_filename_prefix:
                     for key, value in items(local_refdex):
-                        if 'filename' in value:
-                            value['filename'] = input_refdex_filename_prefix + value['filename']
-                        if 'filenames' in value:
-                            value['filenames'] = [input_refdex_filename_prefix + f for f in value['filenames']]
+                        prefix_refdex_entry(value, input_refdex_filename_prefix)
                 refdex.update(local_refdex)
         except:
             sys.stderr.write("Could not read refdex JSON from '{}'\n".format(filename))
             raise
 
-    # Python 2/3
-    try:
-        unicode_string = unicode
-    except NameError:
-        unicode_string = str
-
-    for key, value in items(refdex):
-        try:
-            assert isinstance(key, unicode_string)
-            if 'url' in value:
-                assert len(value) == 1
-                assert isinstance(value['url'], unicode_string)
-                value['url'].encode('utf-8')
-            elif 'filename' in value and 'anchor' in value:
-                assert len(value) == 2
-                assert isinstance(value['filename'], unicode_string)
-                value['filename'].encode('utf-8')
-                assert isinstance(value['anchor'], unicode_string)
-                value['anchor'].encode('utf-8')
-            elif 'filenames' in value and 'anchor' in value:
-                assert len(value) == 2
-                for filename in value['filenames']:
-                    assert isinstance(value, unicode_string)
-                    filename.encode('utf-8')
-                assert isinstance(value['anchor'], unicode_string)
-                value['anchor'].encode('utf-8')
-            else:
-                raise NotImplementedError("badly formed refdex")
-        except:
-            sys.stderr.write("Component of refdex not suitable: '{}: {}'\n".format(repr(key), repr(value)))
-            raise
-
+    check(refdex)
+    if layers:
+        if refdex:
+            layers.append(refdex)
+        return LayeredRefdex(layers)
     return refdex
 
 
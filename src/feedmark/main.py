@@ -1,11 +1,340 @@
 from argparse import ArgumentParser
+from functools import partial
+from itertools import chain
 import json
+import os
 import sys
 
 from feedmark.loader import (
-    read_document_from, read_refdex_from, convert_refdex_to_single_filename_refdex,
+    DocumentCache, iter_sections_from, read_document_from, read_refdex_from,
+    convert_refdex_to_single_filename_refdex,
 )
-from feedmark.utils import items
+from feedmark.parser import ReferenceURLs, rewrite_all_reference_links, rewrite_reference_links
+from feedmark.timings import timed, timings
+from feedmark.utils import items, pool_map, write_file_if_changed, write_json_list
+
+
+# Output modes which need only see one section at a time, and the options
+# which need all of the documents to be loaded at once.  If only the former
+# are given, the input files are read incrementally; see `main_streaming`.
+STREAMING_MODES = ('dump_entries', 'by_property', 'output_links')
+WHOLE_DOCUMENT_MODES = (
+    'output_json', 'by_publication_date', 'output_markdown', 'rewrite_markdown', 'output_html',
+    'output_atom', 'output_refdex', 'check_against_schema', 'cache_dir', 'watch',
+    'property_index', 'check_links', 'feed_spec', 'output_unresolved_refs',
+)
+
+
+def can_stream(options):
+    return (
+        any(getattr(options, mode) for mode in STREAMING_MODES) and
+        not any(getattr(options, mode) for mode in WHOLE_DOCUMENT_MODES) and
+        options.jobs <= 1
+    )
+
+
+def document_to_json_data(document, **kwargs):
+    return document.to_json_data(**kwargs)
+
+
+def condition(text):
+    from feedmark.index import Condition
+    return Condition(text)
+
+
+def input_refdex_filenames(options):
+    input_refdexes = []
+    if options.input_refdex:
+        input_refdexes.append(options.input_refdex)
+    if options.input_refdexes:
+        for input_refdex in options.input_refdexes.split(','):
+            input_refdexes.append(input_refdex.strip())
+    return input_refdexes
+
+
+def load_input_refdex(options):
+    return read_refdex_from(
+        input_refdex_filenames(options), input_refdex_filename_prefix=options.input_refdex_filename_prefix
+    )
+
+
+def dump_entries(sections):
+    for section in sections:
+        print(section.title)
+        for (name, url) in section.images:
+            print(u'    !{}: {}'.format(name, url))
+        for key, value in items(section.properties):
+            if isinstance(value, list):
+                print(u'    {}@'.format(key))
+                for subitem in value:
+                    print(u'        {}'.format(subitem))
+            else:
+                print(u'    {}: {}'.format(key, value))
+
+
+def collect_by_property(sections):
+    by_property = {}
+    for section in sections:
+        for key, value in items(section.properties):
+            if isinstance(value, list):
+                key = u'{}@'.format(key)
+            by_property.setdefault(key, {}).setdefault(section.title, value)
+    return by_property
+
+
+def collect_by_publication_date(documents, limit=None):
+    from feedmark.feeds import construct_entry_url, extract_sections
+
+    output_json = []
+    for section in extract_sections(documents, limit=limit):
+        output_json.append({
+            'title': section.title,
+            'images': section.images,
+            'properties': section.properties,
+            'body': section.body,
+            'url': construct_entry_url(section)
+        })
+    return output_json
+
+
+def collect_refdex(refdex, documents, builder=None):
+    """Add entries for all of the sections of the given documents to the given refdex.
+    If a RefdexBuilder is given, it is used (and updated), so that only the
+    contributions of documents which have changed since it was last used
+    need be recomputed."""
+    from feedmark.refdex import RefdexBuilder
+
+    builder = builder if builder is not None else RefdexBuilder(hash_files=False)
+    builder.update(documents)
+    return builder.collect(refdex)
+
+
+def main_streaming(options):
+    timings.phase('refdex load')
+    refdex = load_input_refdex(options)
+    urls = ReferenceURLs(refdex)
+
+    def iter_documents():
+        # Yields (document, sections) pairs, where sections is a generator which must
+        # be exhausted before the next pair is requested.
+        for filename in options.input_files:
+            stream = iter_sections_from(filename)
+            document = next(stream)
+            if refdex:
+                document.rewrite_reference_links(urls)
+            yield (document, rewrite_sections(stream))
+
+    def rewrite_sections(sections):
+        for section in sections:
+            if options.where and not all(condition.matches(section) for condition in options.where):
+                continue
+            if refdex:
+                section.reference_links = rewrite_reference_links(urls, section.reference_links)
+            yield section
+
+    def iter_all_sections():
+        for (document, sections) in iter_documents():
+            for section in sections:
+                yield section
+
+    if options.dump_entries:
+        timings.phase('dump entries')
+        dump_entries(iter_all_sections())
+
+    if options.by_property:
+        timings.phase('by property')
+        sys.stdout.write(json.dumps(collect_by_property(iter_all_sections()), indent=4))
+
+    if options.output_links:
+        from feedmark.checkers import iter_links_from_document
+
+        def iter_links():
+            for (document, sections) in iter_documents():
+                if options.where:
+                    # as with the property index, a document's own links are only
+                    # included if at least one of its sections meets the conditions
+                    try:
+                        first = next(sections)
+                    except StopIteration:
+                        continue
+                    sections = chain([first], sections)
+                for link in iter_links_from_document(document, sections):
+                    yield link
+
+        timings.phase('output links')
+        write_json_list(iter_links(), sys.stdout)
+
+
+def process(options, documents, cache=None, affected=None, index=None, refdex_builder=None):
+    """Process the loaded documents and produce all of the requested outputs.
+    If `affected` is given, it is the set of filenames of the only documents
+    whose per-document outputs could have changed since this was last called
+    (see `feedmark.watch`); reference links are only rewritten, and files only
+    rewritten by --rewrite-markdown, for those documents.  Outputs written to
+    standard output cover the whole corpus, so are always produced in full.
+    `index` is the PropertyIndex used to select entries for --where, and
+    `refdex_builder`, if given, is the RefdexBuilder used for --output-refdex.
+    Returns a true value if the documents did not pass the schema check, or
+    if --check-links found broken links."""
+
+    if index is not None:
+        timings.phase('where')
+        index.update(documents)
+        if options.property_index is not None:
+            index.save(options.property_index)
+        if options.where:
+            documents = index.select_documents(documents, options.where)
+
+    ### input: load input refdexes
+
+    timings.phase('refdex load')
+    refdex = load_input_refdex(options)
+
+    ### processing
+
+    schema = None
+    if options.check_against_schema is not None:
+        timings.phase('schema')
+        from feedmark.checkers import Schema
+        schema_document = read_document_from(options.check_against_schema, cache=cache)
+        schema = Schema(schema_document)
+        results = schema.check_documents(documents, jobs=options.jobs)
+        if results:
+            sys.stdout.write(json.dumps(results, indent=4, sort_keys=True))
+            timings.end_phase()
+            return results
+
+    ### processing: collect refdex phase
+    # NOTE: we only run this if we were asked to output a refdex -
+    # this is to prevent scurrilous insertion of refdex entries when rewriting.
+
+    if options.output_refdex:
+        timings.phase('collect')
+        # the documents selected by --where are partial copies, so are not kept by the builder
+        collect_refdex(refdex, documents, builder=None if options.where else refdex_builder)
+
+    ### processing: rewrite references phase
+
+    unresolved = None
+    if options.output_unresolved_refs is not None:
+        unresolved = []
+    if refdex or unresolved is not None:
+        timings.phase('rewrite')
+        targets = documents
+        if affected is not None and unresolved is None and not options.where:
+            # the other documents still have the links rewritten last time
+            targets = [document for document in documents if document.filename in affected]
+        rewrite_all_reference_links(targets, refdex, unresolved=unresolved)
+    if unresolved is not None:
+        write_file_if_changed(options.output_unresolved_refs, json.dumps(unresolved, indent=4, sort_keys=True))
+
+    ### output
+
+    if options.output_refdex:
+        timings.phase('output refdex')
+        if options.output_refdex_single_filename:
+            refdex = convert_refdex_to_single_filename_refdex(refdex)
+        sys.stdout.write(json.dumps(dict(items(refdex)), indent=4, sort_keys=True))
+
+    if options.dump_entries:
+        timings.phase('dump entries')
+        dump_entries(section for document in documents for section in document.sections)
+
+    if options.output_json:
+        timings.phase('output json')
+        json_options = {
+            'htmlize': options.htmlized_json,
+            'ordered': options.ordered_json,
+        }
+        output_json = {
+            'documents': pool_map(partial(document_to_json_data, **json_options), documents, jobs=options.jobs)
+        }
+        sys.stdout.write(json.dumps(output_json, indent=4, sort_keys=True))
+
+    if options.by_publication_date:
+        timings.phase('by publication date')
+        output_json = collect_by_publication_date(documents, limit=options.limit)
+        sys.stdout.write(json.dumps(output_json, indent=4, sort_keys=True))
+
+    if options.by_property:
+        timings.phase('by property')
+        by_property = collect_by_property(section for document in documents for section in document.sections)
+        sys.stdout.write(json.dumps(by_property, indent=4))
+
+    if options.output_links:
+        timings.phase('output links')
+        from feedmark.checkers import extract_links_from_documents
+        links = extract_links_from_documents(documents)
+        sys.stdout.write(json.dumps(links, indent=4, sort_keys=True))
+
+    if options.output_markdown:
+        timings.phase('output markdown')
+        from feedmark.formats.markdown import feedmark_markdownize, write_markdown
+        if options.jobs > 1:
+            for s in pool_map(partial(feedmark_markdownize, schema=schema), documents, jobs=options.jobs):
+                sys.stdout.write(s)
+        else:
+            for document in documents:
+                write_markdown(document, sys.stdout, schema=schema)
+
+    if options.rewrite_markdown:
+        timings.phase('rewrite markdown')
+        from feedmark.formats.markdown import feedmark_markdownize
+        targets = documents
+        if affected is not None:
+            targets = [document for document in documents if document.filename in affected]
+        outputs = pool_map(partial(feedmark_markdownize, schema=schema), targets, jobs=options.jobs)
+        rewritten = 0
+        for (document, s) in zip(targets, outputs):
+            if write_file_if_changed(document.filename, s):
+                rewritten += 1
+        sys.stderr.write("Rewrote {} of {} documents\n".format(rewritten, len(targets)))
+
+    if options.output_html:
+        timings.phase('output html')
+        from feedmark.formats.markdown import feedmark_htmlize, write_html
+        if options.jobs > 1 and len(documents) > 1:
+            for s in pool_map(partial(feedmark_htmlize, schema=schema), documents, jobs=options.jobs):
+                sys.stdout.write(s)
+        else:
+            # a single document can still have its sections converted in parallel
+            for document in documents:
+                write_html(document, sys.stdout, schema=schema, jobs=options.jobs)
+
+    if options.output_atom:
+        timings.phase('output atom')
+        from feedmark.formats.atom import feedmark_atomize
+        feedmark_atomize(documents, options.output_atom, limit=options.limit, jobs=options.jobs)
+
+    if options.feed_spec:
+        timings.phase('feed spec')
+        from feedmark.feeds import read_feed_specs
+        from feedmark.formats.atom import feedmark_atomize_feeds
+        specs = read_feed_specs(read_document_from(options.feed_spec, cache=cache))
+        feedmark_atomize_feeds(documents, specs, jobs=options.jobs)
+
+    broken_links = None
+    if options.check_links:
+        timings.phase('check links')
+        from feedmark.checkers import extract_links_from_documents
+        from feedmark.linkcheck import LinkCache, LinkChecker, check_links
+        link_cache = LinkCache(options.link_cache, ttl=options.link_cache_ttl)
+        checker = LinkChecker(
+            cache=link_cache, connections=options.link_check_connections,
+            rate=options.link_check_rate, timeout=options.link_check_timeout,
+            workers=options.link_check_workers
+        )
+        broken_links = check_links(extract_links_from_documents(documents), documents, refdex=refdex, checker=checker)
+        link_cache.save()
+        sys.stdout.write(json.dumps(broken_links, indent=4, sort_keys=True))
+
+    if options.html_fragment_cache is not None:
+        timings.phase('save fragment cache')
+        from feedmark.formats.markdown import fragment_cache
+        fragment_cache.save(options.html_fragment_cache)
+
+    timings.end_phase()
+    return broken_links
 
 
 def sys_main():
@@ -13,9 +342,13 @@ def sys_main():
 
 
 def main(args):
+    if args[:1] == ['serve']:
+        from feedmark.server import main as serve_main
+        return serve_main(args[1:])
+
     argparser = ArgumentParser()
 
-    argparser.add_argument('input_files', nargs='+', metavar='FILENAME', type=str,
+    argparser.add_argument('input_files', nargs='*', metavar='FILENAME', type=str,
         help='Markdown files containing the embedded entries'
     )
 
@@ -42,6 +375,30 @@ def main(args):
     argparser.add_argument('--output-links', action='store_true',
         help='Output JSON containing all web links extracted from the entries'
     )
+    argparser.add_argument('--check-links', action='store_true',
+        help='Check all links extracted from the entries, and output JSON containing those '
+             'which are broken.  Each distinct web link is requested once; links to '
+             'filename#anchor are checked against the input documents and refdexes.  '
+             'Requires Python 3.7 or later.'
+    )
+    argparser.add_argument('--link-cache', metavar='FILENAME', type=str, default=None,
+        help='Save the results of checking web links to this file, and re-use them on later runs'
+    )
+    argparser.add_argument('--link-cache-ttl', metavar='SECONDS', type=float, default=86400,
+        help='Re-use saved results of checking web links for this long (default one day)'
+    )
+    argparser.add_argument('--link-check-connections', metavar='COUNT', type=int, default=4,
+        help='When checking links, make no more than this many requests to any one host at once (default 4)'
+    )
+    argparser.add_argument('--link-check-workers', metavar='COUNT', type=int, default=16,
+        help='When checking links, make no more than this many requests at once, to all hosts (default 16)'
+    )
+    argparser.add_argument('--link-check-rate', metavar='REQUESTS', type=float, default=None,
+        help='When checking links, start no more than this many requests per second to any one host'
+    )
+    argparser.add_argument('--link-check-timeout', metavar='SECONDS', type=float, default=10.0,
+        help='When checking links, give up on a request after this long (default 10)'
+    )
 
     argparser.add_argument('--check-against-schema', metavar='FILENAME', type=str, default=None,
         help='Check if entries have the properties specified by this schema.  This schema will '
@@ -51,6 +408,11 @@ def main(args):
     argparser.add_argument('--output-atom', metavar='FILENAME', type=str,
         help='Construct an Atom XML feed from the entries and write it out to this file'
     )
+    argparser.add_argument('--feed-spec', metavar='FILENAME', type=str, default=None,
+        help='Construct each of the Atom XML feeds described in this Feedmark document, in which '
+             'each entry gives the output file and selection (document, where, since, until, '
+             'limit) of one feed'
+    )
     argparser.add_argument('--output-markdown', action='store_true',
         help='Reconstruct a Markdown document from the entries and write it to stdout'
     )
@@ -74,165 +436,191 @@ def main(args):
     argparser.add_argument('--output-refdex', action='store_true',
         help='Construct reference-style links index from the entries and write it to stdout as JSON'
     )
+    argparser.add_argument('--compile-refdex', metavar='FILENAME', type=str, default=None,
+        help='Merge the input refdexes and write them out to this file as a compiled refdex, '
+             'which can be given to --input-refdex in place of a JSON refdex, and from which '
+             'only the entries which are used are read.  No Markdown files need be given.'
+    )
     argparser.add_argument('--output-refdex-single-filename', action='store_true',
         help='When outputting a refdex, ensure that only entries with a single filename are '
              'output, by stripping all but the last filename from multiple filenames entries.'
     )
+    argparser.add_argument('--output-unresolved-refs', metavar='FILENAME', type=str, default=None,
+        help='When rewriting reference links, write a JSON list of the links whose names are not '
+             'in the input refdex (which keep their URLs) to this file'
+    )
+
+    argparser.add_argument('--where', metavar='CONDITION', type=condition, action='append',
+        help='Process only those entries which meet this condition on their properties: '
+             'key=value (the value is exactly this), key^=value (the value starts with this), '
+             'or key~=value (the value matches this regular expression).  A property with '
+             'multiple values meets the condition if any of its values do.  May be given '
+             'more than once, to select entries which meet all of the conditions.'
+    )
+    argparser.add_argument('--property-index', metavar='FILENAME', type=str, default=None,
+        help='Load an index of the properties of the input documents from this file, if it '
+             'exists, and save it back after processing.  With --where, documents which '
+             'are unchanged and have no entries meeting the conditions are not read at all.'
+    )
 
     argparser.add_argument('--limit', metavar='COUNT', type=int, default=None,
         help='Process no more than this many entries when making an Atom or HTML feed'
     )
 
-    argparser.add_argument('--version', action='version', version="%(prog)s 0.14")
-
-    options = argparser.parse_args(args)
-
-    documents = []
-
-    ### input
-
-    for filename in options.input_files:
-        document = read_document_from(filename)
-        documents.append(document)
-
-    ### input: load input refdexes
-
-    input_refdexes = []
-    if options.input_refdex:
-        input_refdexes.append(options.input_refdex)
-    if options.input_refdexes:
-        for input_refdex in options.input_refdexes.split(','):
-            input_refdexes.append(input_refdex.strip())
-
-    refdex = read_refdex_from(input_refdexes, input_refdex_filename_prefix=options.input_refdex_filename_prefix)
-
-    ### processing
-
-    schema = None
-    if options.check_against_schema is not None:
-        from feedmark.checkers import Schema
-        schema_document = read_document_from(options.check_against_schema)
-        schema = Schema(schema_document)
-        results = schema.check_documents(documents)
-        if results:
-            sys.stdout.write(json.dumps(results, indent=4, sort_keys=True))
-            sys.exit(1)
-
-    ### processing: collect refdex phase
-    # NOTE: we only run this if we were asked to output a refdex -
-    # this is to prevent scurrilous insertion of refdex entries when rewriting.
-
-    if options.output_refdex:
-        for document in documents:
-            for section in document.sections:
-                if section.title in refdex:
-                    entry = refdex[section.title]
-                    if entry['anchor'] != section.anchor:
-                        raise ValueError("Inconsistent anchors: {} in refex, {} in document".format(entry['anchor'], section.anchor))
-                    if 'filename' in entry:
-                        entry['filenames'] = []
-                        del entry['filename']
-                    entry['filenames'].append(document.filename)
-                else:
-                    refdex[section.title] = {
-                        'filenames': [document.filename],
-                        'anchor': section.anchor
-                    }
-
-    ### processing: rewrite references phase
-
-    if refdex:
-        for document in documents:
-            document.rewrite_reference_links(refdex)
-
-    ### output
-
-    if options.output_refdex:
-        if options.output_refdex_single_filename:
-            refdex = convert_refdex_to_single_filename_refdex(refdex)
-        sys.stdout.write(json.dumps(refdex, indent=4, sort_keys=True))
+    argparser.add_argument('--cache-dir', metavar='DIRNAME', type=str, default=None,
+        help='Cache parsed documents in this directory, and re-use them on later runs '
+             'for as long as the input file is unchanged'
+    )
+    argparser.add_argument('--cache-size-limit', metavar='MEGABYTES', type=int, default=None,
+        help='When caching parsed documents, remove least recently used entries from '
+             'the cache until it takes up no more than this much space'
+    )
+    argparser.add_argument('--clear-cache', action='store_true',
+        help='Remove all entries from the document cache before processing'
+    )
 
-    if options.dump_entries:
-        for document in documents:
-            for section in document.sections:
-                print(section.title)
-                for (name, url) in section.images:
-                    print(u'    !{}: {}'.format(name, url))
-                for key, value in items(section.properties):
-                    if isinstance(value, list):
-                        print(u'    {}@'.format(key))
-                        for subitem in value:
-                            print(u'        {}'.format(subitem))
-                    else:
-                        print(u'    {}: {}'.format(key, value))
+    argparser.add_argument('--html-fragment-cache', metavar='FILENAME', type=str, default=None,
+        help='Load the HTML that property values were converted to on previous runs from this '
+             'file, if it exists, and save it back to this file after processing'
+    )
 
-    if options.output_json:
-        json_options = {
-            'htmlize': options.htmlized_json,
-            'ordered': options.ordered_json,
-        }
-        output_json = {
-            'documents': [d.to_json_data(**json_options) for d in documents]
-        }
-        sys.stdout.write(json.dumps(output_json, indent=4, sort_keys=True))
+    argparser.add_argument('--jobs', metavar='COUNT', type=int, default=1,
+        help='Parse, and produce per-document output for, this many documents at once, '
+             'using a pool of worker processes.  Output is in the same order as without it.'
+    )
 
-    if options.by_publication_date:
-        from feedmark.feeds import construct_entry_url
+    argparser.add_argument('--watch', action='store_true',
+        help='After processing, keep the parsed documents in memory, and whenever any input '
+             'file (or refdex or schema) changes, re-read only the changed files and produce '
+             'the outputs again.  Runs until interrupted.'
+    )
+    argparser.add_argument('--watch-interval', metavar='SECONDS', type=float, default=0.05,
+        help='When watching, check the input files for changes this often (default 0.05)'
+    )
 
-        dated_items = []
-        for document in documents:
-            for section in document.sections:
-                section_json = {
-                    'title': section.title,
-                    'images': section.images,
-                    'properties': section.properties,
-                    'body': section.body,
-                    'url': construct_entry_url(section)
-                }
-                dated_items.append((section.publication_date, section_json))
-        dated_items.sort(reverse=True)
-        if options.limit:
-            dated_items = dated_items[:options.limit]
-        output_json = [item for (d, item) in dated_items]
-        sys.stdout.write(json.dumps(output_json, indent=4, sort_keys=True))
+    argparser.add_argument('--timings', action='store_true',
+        help='Write, as JSON to standard error, the wall time and number of calls of each phase '
+             'of processing, and the time taken to read each document'
+    )
+    argparser.add_argument('--timings-memory', action='store_true',
+        help='Also record the peak memory use of each phase in the timings; this slows '
+             'processing down, so the reported times will be longer'
+    )
+    argparser.add_argument('--timings-file', metavar='FILENAME', type=str, default=None,
+        help='Write the timings (as with --timings) to this file instead of standard error'
+    )
+    argparser.add_argument('--profile', metavar='FILENAME', type=str, default=None,
+        help='Run under cProfile, and write the profile (for use with pstats) to this file'
+    )
 
-    if options.by_property:
-        by_property = {}
-        for document in documents:
-            for section in document.sections:
-                for key, value in items(section.properties):
-                    if isinstance(value, list):
-                        key = u'{}@'.format(key)
-                    by_property.setdefault(key, {}).setdefault(section.title, value)
-        sys.stdout.write(json.dumps(by_property, indent=4))
+    argparser.add_argument('--version', action='version', version="%(prog)s 0.14")
 
-    if options.output_links:
-        from feedmark.checkers import extract_links_from_documents
-        links = extract_links_from_documents(documents)
-        sys.stdout.write(json.dumps(links, indent=4, sort_keys=True))
+    options = argparser.parse_args(args)
 
-    if options.output_markdown:
-        from feedmark.formats.markdown import feedmark_markdownize
-        for document in documents:
-            s = feedmark_markdownize(document, schema=schema)
-            sys.stdout.write(s)
+    if not options.input_files and options.compile_refdex is None:
+        argparser.error('at least one input file is required')
+    if options.where and options.rewrite_markdown:
+        argparser.error('--where cannot be used with --rewrite-markdown')
+    if options.check_links and sys.version_info < (3, 7):
+        argparser.error('--check-links requires Python 3.7 or later')
+
+    if options.timings or options.timings_memory or options.timings_file is not None:
+        timings.enable(memory=options.timings_memory)
+    profile = None
+    if options.profile is not None:
+        import cProfile
+        profile = cProfile.Profile()
+        profile.enable()
+    try:
+        return run(options)
+    finally:
+        if profile is not None:
+            profile.disable()
+            profile.dump_stats(options.profile)
+        if timings.enabled:
+            timings.report(options.timings_file)
+            timings.reset()
+
+
+def run(options):
+    if options.compile_refdex is not None:
+        timings.phase('compile refdex')
+        from feedmark.refdex import compile_refdex
+        compile_refdex(load_input_refdex(options), options.compile_refdex)
+        if not options.input_files:
+            return
+
+    if can_stream(options):
+        return main_streaming(options)
+
+    timings.phase('setup')
+    cache = None
+    if options.cache_dir is not None:
+        size_limit = None
+        if options.cache_size_limit is not None:
+            size_limit = options.cache_size_limit * 1024 * 1024
+        cache = DocumentCache(options.cache_dir, size_limit=size_limit)
+        if options.clear_cache:
+            cache.clear()
+
+    if options.html_fragment_cache is not None and os.path.exists(options.html_fragment_cache):
+        from feedmark.formats.markdown import fragment_cache
+        fragment_cache.load(options.html_fragment_cache)
+
+    index = None
+    input_files = options.input_files
+    if options.where or options.property_index is not None:
+        from feedmark.index import PropertyIndex
+        index = PropertyIndex()
+        if options.property_index is not None and os.path.exists(options.property_index):
+            index.load(options.property_index)
+        if options.where and not options.watch:
+            # documents which are known to have no entries that meet the conditions need not be read
+            input_files = [
+                filename for filename in input_files
+                if not index.is_fresh(filename) or index.matching_positions(filename, options.where)
+            ]
 
-    if options.rewrite_markdown:
-        from feedmark.formats.markdown import feedmark_markdownize
-        for document in documents:
-            s = feedmark_markdownize(document, schema=schema)
-            with open(document.filename, 'w') as f:
-                f.write(s)
+    ### input
 
-    if options.output_html:
-        from feedmark.formats.markdown import feedmark_htmlize
+    load = partial(read_document_from, cache=cache)
+    watcher = None
+    if options.watch:
+        from feedmark.watch import Watcher
+        dependencies = input_refdex_filenames(options)
+        if options.check_against_schema is not None:
+            dependencies.append(options.check_against_schema)
+        if options.feed_spec is not None:
+            dependencies.append(options.feed_spec)
+        watcher = Watcher(options.input_files, load, dependencies=dependencies)
+
+    timings.phase('input')
+    if timings.enabled:
+        results = pool_map(partial(timed, load), input_files, jobs=options.jobs)
+        documents = [document for (document, seconds) in results]
+        for (filename, (document, seconds)) in zip(input_files, results):
+            timings.document(filename, 'input', seconds)
+    else:
+        documents = pool_map(load, input_files, jobs=options.jobs)
+
+    if cache is not None:
+        cache.evict()
+
+    if watcher is not None:
         for document in documents:
-            s = feedmark_htmlize(document, schema=schema)
-            sys.stdout.write(s)
-
-    if options.output_atom:
-        from feedmark.formats.atom import feedmark_atomize
-        feedmark_atomize(documents, options.output_atom, limit=options.limit)
+            watcher.set_document(document)
+        from feedmark.refdex import RefdexBuilder
+        refdex_builder = RefdexBuilder()
+        process(options, documents, cache=cache, index=index, refdex_builder=refdex_builder)
+        sys.stdout.flush()
+        watcher.watch(
+            partial(process, options, cache=cache, index=index, refdex_builder=refdex_builder),
+            interval=options.watch_interval
+        )
+        return
+
+    if process(options, documents, cache=cache, index=index):
+        sys.exit(1)
 
 
 if __name__ == '__main__':
@@ -5,51 +5,165 @@ from datetime import datetime
 from collections import OrderedDict
 import re
 
-from feedmark.formats.markdown import markdown_to_html5, markdown_to_html5_deep
-from feedmark.utils import quote
-
-
-def rewrite_reference_links(refdex, reference_links):
+from feedmark.utils import intern, quote, unicode
+
+
+# Formats which the `date` property of a section may be given in, tried in
+# order.  Use `register_date_format` to accept further formats.
+DATE_FORMATS = [
+    "%b %d %Y %H:%M:%S",
+    "%a, %d %b %Y %H:%M:%S GMT",
+]
+
+# strptime is slow, so dates in the usual format (the first one above), and
+# spelled out in the usual way, are parsed by this regular expression instead.
+FAST_DATE_RE = re.compile(r'^([A-Za-z]{3}) (\d{1,2}) (\d{4}) (\d{1,2}):(\d\d):(\d\d)$')
+MONTHS = dict((name, n + 1) for (n, name) in enumerate(
+    ('jan', 'feb', 'mar', 'apr', 'may', 'jun', 'jul', 'aug', 'sep', 'oct', 'nov', 'dec')
+))
+
+ANCHOR_STRIP_RE = re.compile(r'[^\w\s-]')
+ANCHOR_SPACE_RE = re.compile(r'[-\s]')
+
+
+def register_date_format(format):
+    if format not in DATE_FORMATS:
+        DATE_FORMATS.append(format)
+
+
+def parse_date(text):
+    """Parse a date in one of the `DATE_FORMATS`, returning a datetime,
+    or raising ValueError if it is in none of them."""
+    match = FAST_DATE_RE.match(text)
+    if match and match.group(1).lower() in MONTHS:
+        try:
+            return datetime(
+                int(match.group(3)), MONTHS[match.group(1).lower()], int(match.group(2)),
+                int(match.group(4)), int(match.group(5)), int(match.group(6))
+            )
+        except ValueError:
+            pass
+    for format in DATE_FORMATS:
+        try:
+            return datetime.strptime(text, format)
+        except ValueError:
+            pass
+    raise ValueError("date '{}' is not in any known format".format(text))
+
+
+def refdex_entry_url(entry):
+    """Return the URL which the given refdex entry resolves to."""
+    if 'filename' in entry and 'anchor' in entry:
+        filename = quote(entry['filename'].encode('utf-8'))
+        anchor = quote(entry['anchor'].encode('utf-8'))
+        return u'{}#{}'.format(filename, anchor)
+    elif 'filenames' in entry and 'anchor' in entry:
+        # pick the last one, for compatibility with single-refdex style
+        filename = quote(entry['filenames'][-1].encode('utf-8'))
+        anchor = quote(entry['anchor'].encode('utf-8'))
+        return u'{}#{}'.format(filename, anchor)
+    elif 'url' in entry:
+        return entry['url']
+    else:
+        raise ValueError("Badly formed refdex entry: {}".format(entry))
+
+
+class ReferenceURLs(object):
+    """The URLs which the names in a refdex resolve to.  Each name's URL is
+    worked out the first time it is looked up, and remembered, so that a
+    name referred to from many sections is only resolved once."""
+
+    def __init__(self, refdex):
+        self.refdex = refdex
+        self.urls = {}
+
+    def get(self, name):
+        """Return the URL for the given name, or None if it is not in the refdex."""
+        try:
+            return self.urls[name]
+        except KeyError:
+            pass
+        url = refdex_entry_url(self.refdex[name]) if name in self.refdex else None
+        self.urls[name] = url
+        return url
+
+
+def rewrite_reference_links(refdex, reference_links, unresolved=None):
+    """Return the given reference links, with the URL of each one whose name is
+    in the refdex (a dict-like refdex, or a ReferenceURLs) replaced by the URL
+    it resolves to.  Links whose names are not in the refdex keep their URLs;
+    if `unresolved` is given, they are also appended to it."""
+    urls = refdex if isinstance(refdex, ReferenceURLs) else ReferenceURLs(refdex)
     new_reference_links = []
     seen_names = set()
     for (name, url) in reference_links:
         if name in seen_names:
             continue
         seen_names.add(name)
-        if name in refdex:
-            entry = refdex[name]
-            if 'filename' in entry and 'anchor' in entry:
-                filename = quote(entry['filename'].encode('utf-8'))
-                anchor = quote(entry['anchor'].encode('utf-8'))
-                url = u'{}#{}'.format(filename, anchor)
-            elif 'filenames' in entry and 'anchor' in entry:
-                # pick the last one, for compatibility with single-refdex style
-                filename = quote(entry['filenames'][-1].encode('utf-8'))
-                anchor = quote(entry['anchor'].encode('utf-8'))
-                url = u'{}#{}'.format(filename, anchor)
-            elif 'url' in entry:
-                url = entry['url']
-            else:
-                raise ValueError("Badly formed refdex entry: {}".format(entry))
+        resolved = urls.get(name)
+        if resolved is not None:
+            url = resolved
+        elif unresolved is not None:
+            unresolved.append((name, url))
         new_reference_links.append((name, url))
     return new_reference_links
 
 
+def rewrite_all_reference_links(documents, refdex, unresolved=None):
+    """Rewrite the reference links of all of the given documents, resolving
+    each distinct name in the refdex only once.  If `unresolved` is given,
+    a record of each link whose name is not in the refdex is appended to it."""
+    urls = ReferenceURLs(refdex)
+    for document in documents:
+        document.rewrite_reference_links(urls, unresolved=unresolved)
+    return urls
+
+
+def unresolved_link_records(document, section, links):
+    return [
+        {
+            'document': document.title,
+            'filename': document.filename,
+            'section': None if section is None else section.title,
+            'name': name,
+            'url': url,
+        } for (name, url) in links
+    ]
+
+
 class Document(object):
+    __slots__ = ('title', 'properties', 'preamble', 'sections', 'reference_links', 'filename')
+
     def __init__(self, title):
         self.title = title
         self.properties = OrderedDict()
 
         self.preamble = None
         self.sections = []
+        self.reference_links = []
+        self.filename = None
 
     def __str__(self):
         return "document '{}'".format(self.title.encode('utf-8'))
 
-    def rewrite_reference_links(self, refdex):
-        self.reference_links = rewrite_reference_links(refdex, self.reference_links)
+    def copy(self):
+        """Return a shallow copy of this document."""
+        document = Document(self.title)
+        for name in self.__slots__:
+            setattr(document, name, getattr(self, name))
+        return document
+
+    def rewrite_reference_links(self, refdex, unresolved=None):
+        urls = refdex if isinstance(refdex, ReferenceURLs) else ReferenceURLs(refdex)
+        links = None if unresolved is None else []
+        self.reference_links = rewrite_reference_links(urls, self.reference_links, unresolved=links)
+        if links:
+            unresolved.extend(unresolved_link_records(self, None, links))
         for section in self.sections:
-            section.reference_links = rewrite_reference_links(refdex, section.reference_links)
+            links = None if unresolved is None else []
+            section.reference_links = rewrite_reference_links(urls, section.reference_links, unresolved=links)
+            if links:
+                unresolved.extend(unresolved_link_records(self, section, links))
 
     def global_reference_links(self):
         reference_links = []
@@ -61,8 +175,12 @@ class Document(object):
     def to_json_data(self, **kwargs):
 
         if kwargs.get('htmlize', False):
+            from feedmark.formats.markdown import ReferenceLinks, markdown_to_html5, markdown_to_html5_deep
+
             if 'reference_links' not in kwargs:
                 kwargs['reference_links'] = self.global_reference_links()
+            if not isinstance(kwargs['reference_links'], ReferenceLinks):
+                kwargs['reference_links'] = ReferenceLinks(kwargs['reference_links'])
             preamble = markdown_to_html5(self.preamble, reference_links=kwargs['reference_links'])
             properties = markdown_to_html5_deep(self.properties, reference_links=kwargs['reference_links'])
         else:
@@ -87,12 +205,22 @@ class Document(object):
 
 
 class Section(object):
+    __slots__ = (
+        'document', 'title', 'properties', 'images', 'body', 'reference_links',
+        '_anchor', '_publication_date',
+    )
+
     def __init__(self, title):
         self.document = None
         self.title = title
         self.properties = OrderedDict()
 
-        self.lines = []
+        self.images = []
+        self.body = u''
+        self.reference_links = []
+
+        self._anchor = None
+        self._publication_date = None
 
     def __str__(self):
         s = "section '{}'".format(self.title.encode('utf-8'))
@@ -101,35 +229,38 @@ class Section(object):
         return s
 
     @property
-    def body(self):
-        return '\n'.join(self.lines)
+    def lines(self):
+        return self.body.split('\n')
+
+    @lines.setter
+    def lines(self, lines):
+        self.body = '\n'.join(lines)
 
     @property
     def publication_date(self):
-        formats = (
-            "%b %d %Y %H:%M:%S",
-            "%a, %d %b %Y %H:%M:%S GMT",
-        )
-        for format in formats:
+        # computed on first access, as it is used as a sort key
+        if self._publication_date is None:
             try:
-                return datetime.strptime(self.properties['date'], format)
+                date = self.properties['date']
             except KeyError:
                 raise KeyError("could not find 'date' on {}".format(self))
+            try:
+                self._publication_date = parse_date(date)
             except ValueError:
-                pass
-        raise NotImplementedError
+                raise NotImplementedError
+        return self._publication_date
 
     @property
     def anchor(self):
-        return re.sub(
-            r'[-\s]',
-            '-',
-            re.sub(r'[^\w\s-]', '', self.title).strip().lower()
-        )
+        if self._anchor is None:
+            self._anchor = ANCHOR_SPACE_RE.sub('-', ANCHOR_STRIP_RE.sub('', self.title).strip().lower())
+        return self._anchor
 
     def to_json_data(self, **kwargs):
 
         if kwargs.get('htmlize', False):
+            from feedmark.formats.markdown import markdown_to_html5, markdown_to_html5_deep
+
             body = markdown_to_html5(self.body, reference_links=kwargs['reference_links'])
             properties = markdown_to_html5_deep(self.properties, reference_links=kwargs['reference_links'])
         else:
@@ -153,40 +284,94 @@ class Section(object):
         }
 
 
+TITLE_RE = re.compile(r'^\#\s+(.*?)\s*$')
+SETEXT_TITLE_RE = re.compile(r'^\s*(.*?)\s*$')
+SETEXT_UNDERLINE_RE = re.compile(r'^\s*(\=+)\s*$')
+
+# Each of these is only tried on lines that begin with the character(s)
+# that the pattern itself requires, see `LINE_PATTERNS` below.
+BLANK_RE = re.compile(r'^\s*$')
+IMAGE_RE = re.compile(r'^\!\[(.*?)\]\((.*?)\)\s*$')
+LINKED_IMAGE_RE = re.compile(r'^\[\!\[(.*?)\]\((.*?)\)\]\((.*?)\)\s*$')
+PROPERTY_AT_RE = re.compile(r'^\*\s+(.*?)\s*\@\s*(.*?)\s*$')
+PROPERTY_COLON_RE = re.compile(r'^\*\s+(.*?)\s*\:\s*(.*?)\s*$')
+HEADING_RE = re.compile(r'^\#\#\#\s+(.*?)\s*$')
+SECTION_HEADING_RE = re.compile(r'^\#\#\#\s+(.*?)\s*(\#\#\#)?\s*$')
+REFERENCE_LINK_RE = re.compile(r'^\[(.*?)\]\:\s*(.*?)\s*$')
+
+# kind -> (characters a matching line may start with, patterns to try in order)
+LINE_PATTERNS = {
+    'image': ('![', (IMAGE_RE, LINKED_IMAGE_RE)),
+    'property': ('*', (PROPERTY_AT_RE, PROPERTY_COLON_RE)),
+    'heading': ('#', (HEADING_RE,)),
+    'section-heading': ('#', (SECTION_HEADING_RE,)),
+    'reference-link': ('[', (REFERENCE_LINK_RE,)),
+}
+
+
 class Parser(object):
 
     def __init__(self, doc):
-        self.lines = doc.split('\n')
-        self.index = 0
-        self.line = self.lines[self.index]
-        self.index += 1
+        """`doc` is either the text of a document, or an iterable of its lines
+        without their line terminators, such as `split_lines` produces."""
+        if isinstance(doc, (str, unicode)):
+            doc = doc.split('\n')
+        self.lines = iter(doc)
+        self.next_line = next(self.lines, None)
+        self.scan()
 
     def scan(self):
-        self.line = self.lines[self.index]
-        self.index += 1
+        if self.next_line is None:
+            raise IndexError('Unexpected end of document')
+        self.line = self.next_line
+        self.next_line = next(self.lines, None)
+        self.matches = {}
 
     def eof(self):
-        return self.index > len(self.lines) - 1
+        return self.next_line is None
+
+    def match(self, kind):
+        """Return the match of the current line against the pattern(s) for
+        the given kind of line, or None.  Remembered until the next `scan()`."""
+        matches = self.matches
+        if kind in matches:
+            return matches[kind]
+        if kind == 'blank':
+            match = BLANK_RE.match(self.line)
+        else:
+            match = None
+            (initials, patterns) = LINE_PATTERNS[kind]
+            if self.line[:1] in initials:
+                for pattern in patterns:
+                    match = pattern.match(self.line)
+                    if match:
+                        break
+        matches[kind] = match
+        return match
 
     def is_blank_line(self):
-        return re.match(r'^\s*$', self.line)
+        return self.match('blank')
 
     def is_image_line(self):
-        return (
-            re.match(r'^\!\[.*?\]\(.*?\)\s*$', self.line) or
-            re.match(r'^\[\!\[.*?\]\(.*?\)\]\(.*?\)\s*$', self.line)
-        )
+        return self.match('image')
 
     def is_property_line(self):
-        return re.match(r'^\*\s+(.*?)\s*(\:|\@)\s*(.*?)\s*$', self.line)
+        return self.match('property')
 
     def is_heading_line(self):
-        return re.match(r'^\#\#\#\s+(.*?)\s*$', self.line)
+        return self.match('heading')
 
     def is_reference_link_line(self):
-        return re.match(r'^\[(.*?)\]\:\s*(.*?)\s*$', self.line)
+        return self.match('reference-link')
 
     def parse_document(self):
+        stream = self.iter_document()
+        document = next(stream)
+        for section in stream:
+            document.sections.append(section)
+        return document
+
+    def iter_document(self):
         # Feed       ::= :Title Properties Body {Section}.
         # Section    ::= {:Blank} :Heading {Image} Properties Body.
         # Properties ::= {:Blank | :Property}.
@@ -198,46 +383,43 @@ class Parser(object):
         lines, reference_links = self.parse_body()
         document.preamble = u'\n'.join(lines)
         document.reference_links = reference_links
+        yield document
         while not self.eof():
             section = self.parse_section()
             section.document = document
-            document.sections.append(section)
-        return document
+            yield section
 
     def parse_title(self):
-        match = re.match(r'^\#\s+(.*?)\s*$', self.line)
+        match = TITLE_RE.match(self.line)
         if match:
             title = match.group(1)
             self.scan()
             return title
-        match = re.match(r'^\s*(.*?)\s*$', self.line)
+        match = SETEXT_TITLE_RE.match(self.line)
         if match:
             title = match.group(1)
             self.scan()
-            match = re.match(r'^\s*(\=+)\s*$', self.line)
+            match = SETEXT_UNDERLINE_RE.match(self.line)
             if match:
                 self.scan()
                 return title
         raise ValueError('Expected title')
 
     def parse_property(self):
-        match = re.match(r'^\*\s+(.*?)\s*\@\s*(.*?)\s*$', self.line)
-        if match:
-            (key, val) = (match.group(1), match.group(2))
-            self.scan()
-            return ('@', key, val)
-        match = re.match(r'^\*\s+(.*?)\s*\:\s*(.*?)\s*$', self.line)
-        if match:
-            (key, val) = (match.group(1), match.group(2))
-            self.scan()
-            return (':', key, val)
-        raise ValueError('Expected property')
+        match = self.is_property_line()
+        if not match:
+            raise ValueError('Expected property')
+        kind = '@' if match.re is PROPERTY_AT_RE else ':'
+        (key, val) = (match.group(1), match.group(2))
+        self.scan()
+        return (kind, key, val)
 
     def parse_properties(self):
         properties = OrderedDict()
         while self.is_blank_line() or self.is_property_line():
             if self.is_property_line():
                 kind, key, val = self.parse_property()
+                key = intern(key)
                 if kind == ':':
                     if key in properties:
                         raise KeyError('{} already given'.format(key))
@@ -254,7 +436,7 @@ class Parser(object):
         while self.is_blank_line():
             self.scan()
 
-        match = re.match(r'^\#\#\#\s+(.*?)\s*(\#\#\#)?\s*$', self.line)
+        match = self.match('section-heading')
         if not match:
             raise ValueError('Expected section, found "{}"'.format(self.line))
 
@@ -263,22 +445,21 @@ class Parser(object):
         section.images = self.parse_images()
         section.properties = self.parse_properties()
         lines, reference_links = self.parse_body()
-        section.lines = lines
+        section.body = '\n'.join(lines)
         section.reference_links = reference_links
         return section
 
     def parse_images(self):
         images = []
         while self.is_blank_line() or self.is_image_line():
-            if self.is_image_line():
-                match = re.match(r'^\!\[(.*?)\]\((.*?)\)\s*$', self.line)
-                if match:
+            match = self.is_image_line()
+            if match:
+                if match.re is IMAGE_RE:
                     images.append({
                         'description': match.group(1),
                         'source': match.group(2),
                     })
                 else:
-                    match = re.match(r'^\[\!\[(.*?)\]\((.*?)\)\]\((.*?)\)\s*$', self.line)
                     images.append({
                         'description': match.group(1),
                         'source': match.group(2),
@@ -290,18 +471,43 @@ class Parser(object):
     def parse_body(self):
         lines = []
         reference_links = []
-        while not self.eof() and not self.is_heading_line() and not self.is_reference_link_line():
+        while not self.eof():
+            # most body lines can be ruled out as headings or reference links by their first character
+            if self.line[:1] in ('#', '[') and (self.is_heading_line() or self.is_reference_link_line()):
+                break
             lines.append(self.line)
             self.scan()
         while not self.eof() and (self.is_reference_link_line() or self.is_blank_line()):
-            if self.is_reference_link_line():
-                match = re.match(r'^\[(.*?)\]\:\s*(.*?)\s*$', self.line)
-                if match:
-                    reference_links.append((match.group(1), match.group(2)))
+            match = self.is_reference_link_line()
+            if match:
+                reference_links.append((match.group(1), match.group(2)))
             self.scan()
         return (lines, reference_links)
 
 
+def split_lines(fileobj):
+    """Yield the lines read from `fileobj`, without their line terminators.
+    These are the same lines that splitting its entire contents on newlines
+    would give.  The file should be opened with `newline='\\n'` so that other
+    line terminators, such as carriage returns, are kept."""
+    line = u''
+    for line in fileobj:
+        if line.endswith(u'\n'):
+            yield line[:-1]
+        else:
+            yield line
+    if line == u'' or line.endswith(u'\n'):
+        yield u''
+
+
+def iter_sections(fileobj):
+    """Parse a Feedmark document incrementally from a file object.  Yields the
+    Document first, with its title, properties, preamble, and reference links,
+    but no sections; then yields each Section of the document in turn, as soon
+    as it has been completely read.  Sections are not added to the Document."""
+    return Parser(split_lines(fileobj)).iter_document()
+
+
 if __name__ == "__main__":
     import doctest
     doctest.testmod()
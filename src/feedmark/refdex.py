@@ -0,0 +1,266 @@
+# Compiled refdexes: refdexes stored in an SQLite database, so that loading
+# one costs nothing up front, and only the entries which are looked up are read.
+# Also, collecting a refdex from documents incrementally (`RefdexBuilder`).
+
+import json
+import os
+import sys
+import tempfile
+
+from feedmark.utils import copy_file_mode, items, unicode
+
+
+SQLITE_HEADER = b'SQLite format 3\x00'
+
+
+def is_compiled_refdex(filename):
+    with open(filename, 'rb') as f:
+        return f.read(len(SQLITE_HEADER)) == SQLITE_HEADER
+
+
+def check_refdex_entry(key, value):
+    """Raise an exception if the given refdex entry is not well-formed."""
+    try:
+        assert isinstance(key, unicode)
+        if 'url' in value:
+            assert len(value) == 1
+            assert isinstance(value['url'], unicode)
+            value['url'].encode('utf-8')
+        elif 'filename' in value and 'anchor' in value:
+            assert len(value) == 2
+            assert isinstance(value['filename'], unicode)
+            value['filename'].encode('utf-8')
+            assert isinstance(value['anchor'], unicode)
+            value['anchor'].encode('utf-8')
+        elif 'filenames' in value and 'anchor' in value:
+            assert len(value) == 2
+            for filename in value['filenames']:
+                assert isinstance(filename, unicode)
+                filename.encode('utf-8')
+            assert isinstance(value['anchor'], unicode)
+            value['anchor'].encode('utf-8')
+        else:
+            raise NotImplementedError("badly formed refdex")
+    except:
+        sys.stderr.write("Component of refdex not suitable: '{}: {}'\n".format(repr(key), repr(value)))
+        raise
+
+
+def prefix_refdex_entry(value, filename_prefix):
+    if 'filename' in value:
+        value['filename'] = filename_prefix + value['filename']
+    if 'filenames' in value:
+        value['filenames'] = [filename_prefix + f for f in value['filenames']]
+    return value
+
+
+def compile_refdex(refdex, filename):
+    """Write the given refdex (a dict, or anything with `items`) out as a compiled
+    refdex to `filename`, replacing any file there."""
+    import sqlite3
+
+    (dirname, basename) = os.path.split(filename)
+    (fd, temp_filename) = tempfile.mkstemp(dir=dirname or '.', prefix='.' + basename + '.', suffix='.tmp')
+    os.close(fd)
+    try:
+        conn = sqlite3.connect(temp_filename)
+        try:
+            with conn:
+                conn.execute('CREATE TABLE refdex (name TEXT PRIMARY KEY, entry TEXT NOT NULL)')
+                conn.executemany('INSERT INTO refdex (name, entry) VALUES (?, ?)', (
+                    (key, json.dumps(value, sort_keys=True)) for (key, value) in items(refdex)
+                ))
+        finally:
+            conn.close()
+        copy_file_mode(filename, temp_filename)
+        getattr(os, 'replace', os.rename)(temp_filename, filename)
+    except:
+        os.unlink(temp_filename)
+        raise
+
+
+class CompiledRefdex(object):
+    """A compiled refdex file, opened lazily.  Entries are validated when the
+    file is compiled, so they are not checked again here."""
+
+    def __init__(self, filename, filename_prefix=None):
+        self.filename = filename
+        self.filename_prefix = filename_prefix
+        self.conn = None
+
+    def execute(self, sql, *args):
+        if self.conn is None:
+            import sqlite3
+            self.conn = sqlite3.connect(self.filename)
+        return self.conn.execute(sql, args)
+
+    def load_entry(self, text):
+        value = json.loads(text)
+        if self.filename_prefix:
+            value = prefix_refdex_entry(value, self.filename_prefix)
+        return value
+
+    def get(self, key, default=None):
+        row = self.execute('SELECT entry FROM refdex WHERE name = ?', key).fetchone()
+        if row is None:
+            return default
+        return self.load_entry(row[0])
+
+    def keys(self):
+        return [row[0] for row in self.execute('SELECT name FROM refdex ORDER BY name')]
+
+    def items(self):
+        for (key, text) in self.execute('SELECT name, entry FROM refdex ORDER BY name'):
+            yield (key, self.load_entry(text))
+
+    def __len__(self):
+        return self.execute('SELECT COUNT(*) FROM refdex').fetchone()[0]
+
+    def __bool__(self):
+        return self.execute('SELECT 1 FROM refdex LIMIT 1').fetchone() is not None
+
+    __nonzero__ = __bool__
+
+
+class LayeredRefdex(object):
+    """A refdex made up of several layers (dicts, or CompiledRefdexes), where
+    an entry in a later layer takes precedence over one in an earlier layer,
+    as if they had been merged with `dict.update`.  Entries are only read
+    from a layer when they are looked up; looked-up and assigned entries are
+    kept in `self.entries`, so that entries can be modified in place."""
+
+    def __init__(self, layers):
+        self.layers = layers
+        self.entries = {}
+        self.missing = set()
+
+    def lookup(self, key):
+        if key in self.entries:
+            return self.entries[key]
+        if key in self.missing:
+            return None
+        for layer in reversed(self.layers):
+            value = layer.get(key)
+            if value is not None:
+                self.entries[key] = value
+                return value
+        self.missing.add(key)
+        return None
+
+    def __contains__(self, key):
+        return self.lookup(key) is not None
+
+    def __getitem__(self, key):
+        value = self.lookup(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def get(self, key, default=None):
+        value = self.lookup(key)
+        return default if value is None else value
+
+    def __setitem__(self, key, value):
+        self.entries[key] = value
+        self.missing.discard(key)
+
+    def keys(self):
+        keys = set(self.entries)
+        for layer in self.layers:
+            keys.update(layer.keys())
+        return sorted(keys)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def items(self):
+        for key in self.keys():
+            yield (key, self[key])
+
+    def __len__(self):
+        return len(self.keys())
+
+    def __bool__(self):
+        return bool(self.entries) or any(bool(layer) for layer in self.layers)
+
+    __nonzero__ = __bool__
+
+
+def refdex_entries_of(document):
+    """Return what the given document contributes to a collected refdex."""
+    return [(section.title, section.anchor) for section in document.sections]
+
+
+def file_digest(filename):
+    from hashlib import sha1
+
+    try:
+        with open(filename, 'rb') as f:
+            return sha1(f.read()).hexdigest()
+    except (IOError, OSError):
+        return None
+
+
+class RefdexBuilder(object):
+    """Collects refdex entries for all of the sections of a set of documents,
+    as `--output-refdex` does.  What each document contributes (the title and
+    anchor of each of its sections) is kept, keyed by the hash of its file,
+    so that when the documents are given again, only the contributions of
+    those which have changed are recomputed before they are merged.  A
+    builder which will only be used once need not hash the files; give it
+    `hash_files=False`."""
+
+    def __init__(self, hash_files=True):
+        self.hash_files = hash_files
+        self.filenames = []
+        # filename -> (hash of file or None, [(title, anchor)])
+        self.contributions = {}
+        # filename -> the Document the contribution was last taken from
+        self.sources = {}
+
+    def update(self, documents):
+        """Recompute the contributions of any of the given documents which
+        have changed.  Returns the number which were recomputed."""
+        recomputed = 0
+        self.filenames = []
+        for document in documents:
+            filename = document.filename
+            self.filenames.append(filename)
+            if self.sources.get(filename) is document:
+                continue
+            previous = self.contributions.get(filename)
+            digest = file_digest(filename) if self.hash_files else None
+            if digest is None or previous is None or previous[0] != digest:
+                self.contributions[filename] = (digest, refdex_entries_of(document))
+                recomputed += 1
+            self.sources[filename] = document
+        for filename in set(self.contributions) - set(self.filenames):
+            del self.contributions[filename]
+            del self.sources[filename]
+        return recomputed
+
+    def collect(self, refdex):
+        """Add the entries contributed by the documents to the given refdex,
+        which is modified in place and returned.  Raises ValueError if an
+        anchor disagrees with the anchor of an entry with the same title,
+        whether in the given refdex or in another document."""
+        collected = {}
+        for filename in self.filenames:
+            for (title, anchor) in self.contributions[filename][1]:
+                entry = collected.get(title)
+                if entry is None:
+                    if title in refdex:
+                        entry = refdex[title]
+                        if entry['anchor'] != anchor:
+                            raise ValueError("Inconsistent anchors: {} in refex, {} in document".format(entry['anchor'], anchor))
+                        if 'filename' in entry:
+                            entry['filenames'] = []
+                            del entry['filename']
+                    else:
+                        entry = {'filenames': [], 'anchor': anchor}
+                        refdex[title] = entry
+                    collected[title] = entry
+                elif entry['anchor'] != anchor:
+                    raise ValueError("Inconsistent anchors: {} in refex, {} in document".format(entry['anchor'], anchor))
+                entry['filenames'].append(filename)
+        return refdex
@@ -0,0 +1,252 @@
+# `feedmark serve`: load a set of Feedmark documents once, and answer queries
+# about them over HTTP, so that scripts which would otherwise run `feedmark`
+# over and over need not pay for starting it up and parsing every time.
+#
+# Each query is a GET of `/<name>`, with parameters in the query string, and
+# its response is the same as the output of the corresponding command-line
+# option:
+#
+#     /json                   --output-json (params: htmlize, ordered, document)
+#     /by-publication-date    --by-publication-date (params: limit)
+#     /by-property            --by-property
+#     /links                  --output-links (params: document)
+#     /refdex                 --output-refdex (params: single-filename)
+#     /html                   --output-html (params: document)
+#
+# where `document` (which may be given more than once) restricts the query
+# to the documents read from those files.  Before answering each query, the
+# files are checked, and any which have changed are read again.
+
+from argparse import ArgumentParser
+from functools import partial
+import json
+import sys
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from urllib.parse import urlencode, urlparse, parse_qs
+    from urllib.request import urlopen
+    from urllib.error import HTTPError
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from urllib import urlencode
+    from urlparse import urlparse, parse_qs
+    from urllib2 import urlopen, HTTPError
+
+from feedmark.loader import DocumentCache, read_document_from, read_refdex_from, convert_refdex_to_single_filename_refdex
+from feedmark.main import collect_by_property, collect_by_publication_date, collect_refdex
+from feedmark.parser import rewrite_all_reference_links
+from feedmark.refdex import RefdexBuilder
+from feedmark.utils import items
+from feedmark.watch import Watcher
+
+
+DEFAULT_PORT = 7171
+
+
+class Corpus(object):
+    """The documents being served, with their reference links rewritten
+    according to the input refdexes, as on the command line."""
+
+    def __init__(self, filenames, refdex_filenames=(), refdex_filename_prefix=None, load=read_document_from):
+        self.filenames = list(filenames)
+        self.refdex_filenames = list(refdex_filenames)
+        self.refdex_filename_prefix = refdex_filename_prefix
+        self.watcher = Watcher(self.filenames, load, dependencies=self.refdex_filenames)
+        self.refdex_builder = RefdexBuilder()
+        for filename in self.filenames:
+            self.watcher.set_document(load(filename))
+        self.refresh()
+
+    def load_refdex(self):
+        return read_refdex_from(self.refdex_filenames, input_refdex_filename_prefix=self.refdex_filename_prefix)
+
+    def refresh(self):
+        self.documents = self.watcher.get_documents()
+        self.by_filename = dict((document.filename, document) for document in self.documents)
+        refdex = self.load_refdex()
+        if refdex:
+            rewrite_all_reference_links(self.documents, refdex)
+        self.collected_refdex = None
+
+    def revalidate(self):
+        """Re-read any files which have changed since they were last read."""
+        (changed, affected) = self.watcher.poll()
+        if changed:
+            self.refresh()
+
+    def get_documents(self, filenames=None):
+        if not filenames:
+            return self.documents
+        try:
+            return [self.by_filename[filename] for filename in filenames]
+        except KeyError as e:
+            raise LookupError("No such document: {}".format(e))
+
+    def get_refdex(self):
+        if self.collected_refdex is None:
+            self.collected_refdex = dict(items(collect_refdex(self.load_refdex(), self.documents, builder=self.refdex_builder)))
+        return self.collected_refdex
+
+
+def flag(params, name):
+    return params.get(name, [''])[-1].lower() in ('1', 'true', 'yes')
+
+
+def query_json(corpus, params):
+    options = {'htmlize': flag(params, 'htmlize'), 'ordered': flag(params, 'ordered')}
+    return {'documents': [
+        document.to_json_data(**options) for document in corpus.get_documents(params.get('document'))
+    ]}
+
+
+def query_by_publication_date(corpus, params):
+    limit = params.get('limit')
+    return collect_by_publication_date(corpus.documents, limit=int(limit[-1]) if limit else None)
+
+
+def query_by_property(corpus, params):
+    return collect_by_property(section for document in corpus.documents for section in document.sections)
+
+
+def query_links(corpus, params):
+    from feedmark.checkers import extract_links_from_documents
+    return extract_links_from_documents(corpus.get_documents(params.get('document')))
+
+
+def query_refdex(corpus, params):
+    refdex = corpus.get_refdex()
+    if flag(params, 'single-filename'):
+        refdex = convert_refdex_to_single_filename_refdex(refdex)
+    return refdex
+
+
+def query_html(corpus, params):
+    from feedmark.formats.markdown import feedmark_htmlize
+    return u''.join(feedmark_htmlize(document) for document in corpus.get_documents(params.get('document')))
+
+
+# name -> (function, content type).  Functions with a content type of
+# application/json return data to be dumped the same way the command line does.
+QUERIES = {
+    'json': (query_json, 'application/json'),
+    'by-publication-date': (query_by_publication_date, 'application/json'),
+    'by-property': (query_by_property, 'application/json'),
+    'links': (query_links, 'application/json'),
+    'refdex': (query_refdex, 'application/json'),
+    'html': (query_html, 'text/html'),
+}
+
+
+def answer(corpus, name, params):
+    """Return (content type, text) for the named query."""
+    (fun, content_type) = QUERIES[name]
+    result = fun(corpus, params)
+    if content_type == 'application/json':
+        result = json.dumps(result, indent=4, sort_keys=(name != 'by-property'))
+    return (content_type, result)
+
+
+class FeedmarkRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        name = url.path.strip('/')
+        if name not in QUERIES:
+            return self.respond(404, 'text/plain', u"No such query: {}".format(name))
+        try:
+            self.server.corpus.revalidate()
+            (content_type, text) = answer(self.server.corpus, name, parse_qs(url.query))
+        except LookupError as e:
+            return self.respond(404, 'text/plain', u"{}".format(e))
+        except Exception as e:
+            return self.respond(500, 'text/plain', u"{}: {}".format(e.__class__.__name__, e))
+        self.respond(200, content_type, text)
+
+    def respond(self, status, content_type, text):
+        body = text.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', '{}; charset=utf-8'.format(content_type))
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+
+def make_server(corpus, host='127.0.0.1', port=DEFAULT_PORT, verbose=False):
+    server = HTTPServer((host, port), FeedmarkRequestHandler)
+    server.corpus = corpus
+    server.verbose = verbose
+    return server
+
+
+def query(name, base_url='http://127.0.0.1:{}'.format(DEFAULT_PORT), **params):
+    """Client for a running `feedmark serve`.  Returns the parsed JSON (or, for
+    `html`, the text) of the response to the named query.  Parameters whose
+    names contain hyphens can be given with underscores; list values are
+    given as repeated parameters."""
+    query_string = urlencode(
+        [(key.replace('_', '-'), v) for (key, value) in sorted(params.items())
+         for v in (value if isinstance(value, (list, tuple)) else [value])]
+    )
+    try:
+        response = urlopen('{}/{}?{}'.format(base_url.rstrip('/'), name, query_string))
+    except HTTPError as e:
+        raise LookupError(e.read().decode('utf-8'))
+    text = response.read().decode('utf-8')
+    if QUERIES[name][1] == 'application/json':
+        return json.loads(text)
+    return text
+
+
+def main(args):
+    argparser = ArgumentParser(prog='feedmark serve')
+
+    argparser.add_argument('input_files', nargs='+', metavar='FILENAME', type=str,
+        help='Markdown files containing the embedded entries'
+    )
+    argparser.add_argument('--host', type=str, default='127.0.0.1',
+        help='Listen on this interface (default 127.0.0.1)'
+    )
+    argparser.add_argument('--port', type=int, default=DEFAULT_PORT,
+        help='Listen on this port (default {})'.format(DEFAULT_PORT)
+    )
+    argparser.add_argument('--input-refdex', metavar='FILENAME', type=str,
+        help='Load this JSON file as the reference-style links index'
+    )
+    argparser.add_argument('--input-refdexes', metavar='FILENAME', type=str,
+        help='Load these JSON files as the reference-style links index'
+    )
+    argparser.add_argument('--input-refdex-filename-prefix', type=str, default=None,
+        help='After loading refdexes, prepend this to filename of each refdex'
+    )
+    argparser.add_argument('--cache-dir', metavar='DIRNAME', type=str, default=None,
+        help='Cache parsed documents in this directory, as with the main command'
+    )
+    argparser.add_argument('--verbose', action='store_true',
+        help='Log each request to stderr'
+    )
+
+    options = argparser.parse_args(args)
+
+    from feedmark.main import input_refdex_filenames
+
+    load = read_document_from
+    if options.cache_dir is not None:
+        load = partial(read_document_from, cache=DocumentCache(options.cache_dir))
+    corpus = Corpus(
+        options.input_files, refdex_filenames=input_refdex_filenames(options),
+        refdex_filename_prefix=options.input_refdex_filename_prefix, load=load
+    )
+    server = make_server(corpus, host=options.host, port=options.port, verbose=options.verbose)
+    sys.stderr.write("Serving {} documents on http://{}:{}/\n".format(len(corpus.documents), options.host, server.server_port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
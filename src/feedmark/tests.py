@@ -1,17 +1,28 @@
 import unittest
 
+from datetime import datetime
 import json
 import os
 import sys
+import time
 from subprocess import check_call
 from tempfile import mkdtemp
 
 from feedmark.checkers import Schema
 from feedmark.main import main
-from feedmark.loader import read_document_from
+from feedmark.formats.markdown import (
+    FragmentCache, ReferenceLinks, feedmark_htmlize, feedmark_htmlize_whole, feedmark_markdownize, markdown_to_html5, markdown_to_html5_deep, write_markdown,
+)
+from feedmark.loader import DocumentCache, iter_sections_from, read_document_from, read_refdex_from
+from feedmark.parser import DATE_FORMATS, Parser, register_date_format, rewrite_all_reference_links, split_lines
+from feedmark.refdex import CompiledRefdex, LayeredRefdex, compile_refdex
 from feedmark.utils import StringIO
 
 
+# Upper limit, in seconds, on how long importing feedmark.main may take.
+IMPORT_TIME_BUDGET = 0.1
+
+
 class TestFeedmarkFileCreation(unittest.TestCase):
 
     def setUp(self):
@@ -42,6 +53,149 @@ class TestFeedmarkFileCreation(unittest.TestCase):
         )
         os.unlink('feed.xml')
 
+    def test_atom_feed_streamed(self):
+        import atomize
+        from feedmark.feeds import extract_feed_properties, extract_sections
+        from feedmark.formats.atom import convert_section_to_entry, write_feed
+
+        document = read_document_from("{}/eg/Recent Llama Sightings.md".format(self.prevdir))
+        properties = extract_feed_properties(document)
+        entries = [convert_section_to_entry(section, properties) for section in extract_sections([document])]
+
+        def make_feed(entries):
+            return atomize.Feed(
+                author=properties['author'], title=properties['title'], updated=datetime(2020, 1, 1),
+                guid=properties['url'], self_link=properties['url'], entries=entries
+            )
+        make_feed(entries).write_file('expected.xml')
+        with open('feed.xml', 'wb') as f:
+            write_feed(f, make_feed([]), iter(entries))
+        with open('expected.xml', 'rb') as f:
+            expected = f.read()
+        with open('feed.xml', 'rb') as f:
+            self.assertEqual(f.read(), expected)
+
+        os.unlink('feed.xml')
+        umask = os.umask(0o022)
+        try:
+            main(["{}/eg/Recent Llama Sightings.md".format(self.prevdir), '--output-atom=feed.xml', '--jobs=2'])
+        finally:
+            os.umask(umask)
+        self.assert_file_contains('feed.xml', '<id>http://example.com/llama.xml/2 Llamas Spotted Near Mall</id>')
+        # a new feed gets the usual mode for a new file, not that of the temporary file
+        self.assertEqual(os.stat('feed.xml').st_mode & 0o777, 0o644)
+        os.unlink('expected.xml')
+
+        # if rendering fails partway through, the previous feed is left in place
+        import feedmark.formats.atom
+        with open('feed.xml', 'rb') as f:
+            previous = f.read()
+        rendered = []
+
+        def failing_markdown_to_html5(text):
+            if rendered:
+                raise ValueError("cannot render")
+            rendered.append(text)
+            return markdown_to_html5(text)
+
+        feedmark.formats.atom.markdown_to_html5 = failing_markdown_to_html5
+        try:
+            with self.assertRaises(ValueError):
+                feedmark.formats.atom.feedmark_atomize([document], 'feed.xml')
+        finally:
+            feedmark.formats.atom.markdown_to_html5 = markdown_to_html5
+        with open('feed.xml', 'rb') as f:
+            self.assertEqual(f.read(), previous)
+        self.assertEqual(os.listdir('.'), ['feed.xml'])
+        os.unlink('feed.xml')
+
+    def test_feed_spec(self):
+        with open('feeds.md', 'w') as f:
+            f.write("""# Feeds
+
+### Recent Llama Sightings
+
+*   output: recent.xml
+*   document: Recent Llama Sightings
+
+All recent sightings.
+
+### Sightings by Gregor Samsa
+
+*   output: samsa.xml
+*   where: reporter=Gregor Samsa
+*   url: http://example.com/samsa.xml
+
+Sightings reported by Gregor Samsa.
+
+### Latest Sightings
+
+*   output: latest.xml
+*   since: Jan 1 1980 00:00:00
+*   until: Dec 31 2016 00:00:00
+*   limit: 2
+
+The latest sightings in any document.
+
+""")
+        main([
+            "{}/eg/Recent Llama Sightings.md".format(self.prevdir),
+            "{}/eg/Ancient Llama Sightings.md".format(self.prevdir),
+            '--feed-spec=feeds.md', '--jobs=2',
+        ])
+        with open('recent.xml', 'r') as f:
+            recent = f.read()
+        self.assertIn('<title type="text">Recent Llama Sightings</title>', recent)
+        self.assertEqual(recent.count('<entry>'), 3)
+        self.assertIn('<id>http://example.com/llama.xml/2 Llamas Spotted Near Mall</id>', recent)
+        self.assertNotIn('Maybe sighting the llama', recent)
+        with open('samsa.xml', 'r') as f:
+            samsa = f.read()
+        self.assertIn('<title type="text">Sightings by Gregor Samsa</title>', samsa)
+        self.assertIn('<id>http://example.com/samsa.xml/A Possible Llama Under the Bridge</id>', samsa)
+        self.assertEqual(samsa.count('<entry>'), 1)
+        with open('latest.xml', 'r') as f:
+            latest = f.read()
+        self.assertEqual(latest.count('<entry>'), 2)
+        self.assertLess(latest.index('A Possible Llama Under the Bridge'), latest.index("Llamas: It's Time to Spot Them"))
+        self.assertNotIn('2 Llamas Spotted Near Mall', latest)
+        self.assertNotIn('Maybe sighting the llama', latest)
+        for filename in ('feeds.md', 'recent.xml', 'samsa.xml', 'latest.xml'):
+            os.unlink(filename)
+
+    def test_feed_spec_properties(self):
+        # the spec can give the author and url which the documents lack
+        with open('plain.md', 'w') as f:
+            f.write("# Plain Sightings\n\n### A Sighting\n\n*   date: Jan 1 2017 13:45:30\n\nA llama.\n\n")
+        plain_feed = """
+### Plain Feed
+
+*   output: plain.xml
+*   author: Somebody Else
+*   url: http://example.com/plain.xml
+
+A feed.
+"""
+        authorless_feed = """
+### Authorless Feed
+
+*   output: authorless.xml
+
+Another feed.
+"""
+        with open('one-feed.md', 'w') as f:
+            f.write("# Feeds\n" + plain_feed + "\n")
+        with open('feeds.md', 'w') as f:
+            f.write("# Feeds\n" + plain_feed + authorless_feed + "\n")
+        main(['plain.md', '--feed-spec=one-feed.md'])
+        self.assert_file_contains('plain.xml', '<name>Somebody Else</name>')
+        self.assert_file_contains('plain.xml', '<id>http://example.com/plain.xml/A Sighting</id>')
+        with self.assertRaises(ValueError) as context:
+            main(['plain.md', '--feed-spec=feeds.md'])
+        self.assertIn("Feed 'Authorless Feed' in feed spec has no author", str(context.exception))
+        for filename in ('plain.md', 'feeds.md', 'one-feed.md', 'plain.xml'):
+            os.unlink(filename)
+
     def test_rewrite_markdown_input_refdex(self):
         with open('foo.md', 'w') as f:
             f.write("""# Document
@@ -56,6 +210,326 @@ Have you heard, [2 Llamas Spotted Near Mall]()?
         self.assert_file_contains('foo.md', '[2 Llamas Spotted Near Mall]: eg/Recent%20Llama%20Sightings.md#2-llamas-spotted-near-mall')
         os.unlink('foo.md')
 
+    def test_output_unresolved_refs(self):
+        with open('foo.md', 'w') as f:
+            f.write("""# Document
+
+[Elsewhere]: http://example.com/elsewhere
+
+### Entry
+
+Have you heard, [2 Llamas Spotted Near Mall]()?  Or [Nonexistent]()?
+
+[2 Llamas Spotted Near Mall]: TK
+[Nonexistent]: TK
+
+### Another Entry
+
+Yes, [2 Llamas Spotted Near Mall]().
+
+[2 Llamas Spotted Near Mall]: TK
+""")
+        main(["foo.md", "--input-refdex={}/eg/refdex.json".format(self.prevdir), '--output-markdown',
+              '--output-unresolved-refs=unresolved.json'])
+        output = sys.stdout.getvalue()
+        self.assertEqual(output.count(
+            '[2 Llamas Spotted Near Mall]: eg/Recent%20Llama%20Sightings.md#2-llamas-spotted-near-mall'
+        ), 2)
+        self.assertIn('[Nonexistent]: TK', output)
+        with open('unresolved.json', 'r') as f:
+            self.assertEqual(json.loads(f.read()), [
+                {'document': 'Document', 'filename': 'foo.md', 'section': None,
+                 'name': 'Elsewhere', 'url': 'http://example.com/elsewhere'},
+                {'document': 'Document', 'filename': 'foo.md', 'section': 'Entry',
+                 'name': 'Nonexistent', 'url': 'TK'},
+            ])
+        os.unlink('foo.md')
+        os.unlink('unresolved.json')
+
+    def test_timings(self):
+        import pstats
+
+        filename = "{}/eg/Recent Llama Sightings.md".format(self.prevdir)
+        main([filename, "--input-refdex={}/eg/refdex.json".format(self.prevdir), '--output-html',
+              '--output-refdex', '--timings-file=timings.json', '--profile=feedmark.prof'])
+        with open('timings.json', 'r') as f:
+            data = json.loads(f.read())
+        self.assertEqual(
+            [phase['name'] for phase in data['phases']],
+            ['setup', 'input', 'refdex load', 'collect', 'rewrite', 'output refdex', 'output html']
+        )
+        for phase in data['phases']:
+            self.assertEqual(phase['calls'], 1)
+            self.assertGreaterEqual(phase['seconds'], 0.0)
+            # memory is not traced unless asked for, as that slows everything down
+            self.assertIsNone(phase['peak_memory'])
+        self.assertEqual(list(data['documents'].keys()), [filename])
+        self.assertIn('input', data['documents'][filename])
+        self.assertGreater(pstats.Stats('feedmark.prof').total_calls, 0)
+
+        main([filename, '--output-html', '--timings-file=timings.json', '--timings-memory'])
+        with open('timings.json', 'r') as f:
+            data = json.loads(f.read())
+        if sys.version_info >= (3, 4):
+            for phase in data['phases']:
+                self.assertGreater(phase['peak_memory'], 0)
+        os.unlink('timings.json')
+        os.unlink('feedmark.prof')
+
+    def test_compiled_refdex(self):
+        with open('foo.md', 'w') as f:
+            f.write("""# Document
+
+### Entry
+
+Have you heard, [2 Llamas Spotted Near Mall]()?
+
+[2 Llamas Spotted Near Mall]: TK
+""")
+        main(["--input-refdex={}/eg/refdex.json".format(self.prevdir), '--compile-refdex=refdex.db'])
+        main(["foo.md", "--input-refdex=refdex.db", '--input-refdex-filename-prefix=../', '--rewrite-markdown'])
+        self.assert_file_contains('foo.md', '[2 Llamas Spotted Near Mall]: ../eg/Recent%20Llama%20Sightings.md#2-llamas-spotted-near-mall')
+        sys.stdout = StringIO()
+        main(["foo.md", "--input-refdex=refdex.db", '--output-refdex'])
+        self.assertEqual(json.loads(sys.stdout.getvalue()), {
+            "2 Llamas Spotted Near Mall": {
+                "anchor": "2-llamas-spotted-near-mall",
+                "filename": "eg/Recent Llama Sightings.md"
+            },
+            "Entry": {
+                "anchor": "entry",
+                "filenames": ["foo.md"]
+            }
+        })
+        os.unlink('foo.md')
+
+    def test_refdex_builder(self):
+        from feedmark.refdex import RefdexBuilder
+
+        for (filename, titles) in (('a.md', ['Shared', 'Only A']), ('b.md', ['Shared', 'Only B'])):
+            with open(filename, 'w') as f:
+                f.write(u'# {}\n'.format(filename) + u''.join(u'\n### {}\n\nText.\n'.format(t) for t in titles) + u'\n')
+        documents = [read_document_from('a.md'), read_document_from('b.md')]
+        builder = RefdexBuilder()
+        self.assertEqual(builder.update(documents), 2)
+        refdex = builder.collect({u'Shared': {u'filename': u'old.md', u'anchor': u'shared'}})
+        self.assertEqual(refdex, {
+            u'Shared': {u'filenames': [u'a.md', u'b.md'], u'anchor': u'shared'},
+            u'Only A': {u'filenames': [u'a.md'], u'anchor': u'only-a'},
+            u'Only B': {u'filenames': [u'b.md'], u'anchor': u'only-b'},
+        })
+
+        documents[1] = read_document_from('b.md')
+        self.assertEqual(builder.update(documents), 0)
+        with open('b.md', 'a') as f:
+            f.write(u'### Also B\n\nText.\n\n')
+        documents[1] = read_document_from('b.md')
+        self.assertEqual(builder.update(documents), 1)
+        self.assertEqual(builder.collect({})[u'Also B'], {u'filenames': [u'b.md'], u'anchor': u'also-b'})
+        self.assertEqual(builder.update(documents[1:]), 0)
+        self.assertNotIn(u'Only A', builder.collect({}))
+
+        with self.assertRaises(ValueError) as context:
+            builder.collect({u'Shared': {u'filename': u'old.md', u'anchor': u'elsewhere'}})
+        self.assertEqual(str(context.exception), "Inconsistent anchors: elsewhere in refex, shared in document")
+        os.unlink('a.md')
+        os.unlink('b.md')
+
+    def test_compiled_refdex_layers(self):
+        with open('later.json', 'w') as f:
+            f.write(json.dumps({
+                "2 Llamas Spotted Near Mall": {"url": "http://example.com/llamas"},
+                "Entry": {"anchor": "entry", "filenames": ["foo.md", "bar.md"]},
+            }))
+        main(["--input-refdex={}/eg/refdex.json".format(self.prevdir), '--compile-refdex=earlier.db'])
+        refdex = read_refdex_from(['earlier.db', 'later.json'])
+        self.assertEqual(refdex["2 Llamas Spotted Near Mall"], {"url": "http://example.com/llamas"})
+        self.assertEqual(refdex.get("Entry"), {"anchor": "entry", "filenames": ["foo.md", "bar.md"]})
+        self.assertNotIn("Nonexistent", refdex)
+        self.assertEqual(len(refdex), 2)
+        self.assertTrue(refdex)
+        umask = os.umask(0o022)
+        try:
+            compile_refdex({}, 'empty.db')
+        finally:
+            os.umask(umask)
+        self.assertEqual(os.stat('empty.db').st_mode & 0o777, 0o644)
+        self.assertFalse(CompiledRefdex('empty.db'))
+        self.assertFalse(LayeredRefdex([CompiledRefdex('empty.db')]))
+        self.assertTrue(LayeredRefdex([CompiledRefdex('empty.db'), CompiledRefdex('earlier.db')]))
+        refdex = read_refdex_from(['later.json', 'earlier.db'])
+        self.assertEqual(refdex["2 Llamas Spotted Near Mall"], {
+            "anchor": "2-llamas-spotted-near-mall",
+            "filename": "eg/Recent Llama Sightings.md"
+        })
+
+    def test_watcher(self):
+        from feedmark.watch import Watcher
+
+        for (filename, title) in (('a.md', 'Apple'), ('b.md', 'Banana')):
+            with open(filename, 'w') as f:
+                f.write("# Document\n\n### {}\n\nSee [{}]().\n\n[{}]: TK\n".format(title, title, title))
+        watcher = Watcher(['a.md', 'b.md'], read_document_from)
+        for filename in ('a.md', 'b.md'):
+            watcher.set_document(read_document_from(filename))
+        self.assertEqual(watcher.poll(), ([], set()))
+        unchanged = watcher.documents['b.md']
+
+        with open('a.md', 'w') as f:
+            f.write("# Document\n\n### Apple\n\nSee [Apple]() again.\n\n[Apple]: TK\n")
+        os.utime('a.md', (0, 1000000))
+        self.assertEqual(watcher.poll(), (['a.md'], set(['a.md'])))
+        self.assertIn('again', watcher.documents['a.md'].sections[0].body)
+        self.assertIs(watcher.documents['b.md'], unchanged)
+
+        # rewritten reference links are restored before the next round of processing
+        for document in watcher.get_documents():
+            document.rewrite_reference_links({'Banana': {'url': 'http://example.com/banana'}})
+        self.assertEqual(unchanged.sections[0].reference_links, [('Banana', 'http://example.com/banana')])
+        watcher.get_documents()
+        self.assertEqual(unchanged.sections[0].reference_links, [('Banana', 'TK')])
+
+        # links which are not restored keep the URLs they were rewritten to
+        for document in watcher.get_documents():
+            document.rewrite_reference_links({'Banana': {'url': 'http://example.com/banana'}})
+        watcher.get_documents(set(['a.md']))
+        self.assertEqual(unchanged.sections[0].reference_links, [('Banana', 'http://example.com/banana')])
+
+        # a retitled section may affect how links in every document are rewritten
+        with open('a.md', 'w') as f:
+            f.write("# Document\n\n### Apricot\n\nSee [Apple]().\n\n[Apple]: TK\n")
+        os.utime('a.md', (0, 2000000))
+        self.assertEqual(watcher.poll(), (['a.md'], None))
+
+    def test_watch_rewrites_only_affected_documents(self):
+        import feedmark.main
+        import feedmark.watch
+
+        for (filename, title, other) in (('a.md', 'Apple', 'Banana'), ('b.md', 'Banana', 'Apple')):
+            with open(filename, 'w') as f:
+                f.write("# Document\n\n### {}\n\nSee [{}]().\n\n[{}]: TK\n".format(title, other, other))
+        with open('refdex.json', 'w') as f:
+            f.write(json.dumps({
+                "Apple": {"url": "http://example.com/apple"},
+                "Banana": {"url": "http://example.com/banana"},
+            }))
+        rewritten = []
+
+        def recording_rewrite_all_reference_links(documents, refdex, unresolved=None):
+            rewritten.append([document.filename for document in documents])
+            return rewrite_all_reference_links(documents, refdex, unresolved=unresolved)
+
+        def watch_once(watcher, process, interval=0.05):
+            with open('a.md', 'w') as f:
+                f.write("# Document\n\n### Apple\n\nSee [Banana]() again.\n\n[Banana]: TK\n")
+            os.utime('a.md', (0, 1000000))
+            (changed, affected) = watcher.poll()
+            process(watcher.get_documents(affected), affected=affected)
+
+        original_watch = feedmark.watch.Watcher.watch
+        feedmark.main.rewrite_all_reference_links = recording_rewrite_all_reference_links
+        feedmark.watch.Watcher.watch = watch_once
+        try:
+            main(['a.md', 'b.md', '--input-refdex=refdex.json', '--output-links', '--watch'])
+        finally:
+            feedmark.main.rewrite_all_reference_links = rewrite_all_reference_links
+            feedmark.watch.Watcher.watch = original_watch
+        self.assertEqual(rewritten, [['a.md', 'b.md'], ['a.md']])
+
+        output = sys.stdout.getvalue()
+        (first, end) = json.JSONDecoder().raw_decode(output)
+        (second, end) = json.JSONDecoder().raw_decode(output, end)
+        for links in (first, second):
+            self.assertEqual(
+                [link['url'] for link in links if 'name' in link],
+                ['http://example.com/banana', 'http://example.com/apple']
+            )
+
+    def test_property_index(self):
+        for (filename, platform) in (('a.md', 'ZX Spectrum'), ('b.md', 'Commodore 64')):
+            with open(filename, 'w') as f:
+                f.write("# Games\n\n### Game\n\n*   platform: {}\n\nA game.\n\n".format(platform))
+            os.utime(filename, (1000000, 1000000))
+        main(['a.md', 'b.md', '--property-index=index.json', '--output-json'])
+        self.assertTrue(os.path.exists('index.json'))
+
+        # b.md is known to have no matching entries, so it is not read again
+        # for as long as it appears to be unchanged
+        with open('b.md', 'r') as f:
+            size = len(f.read())
+        with open('b.md', 'w') as f:
+            f.write('!' * size)
+        os.utime('b.md', (1000000, 1000000))
+        sys.stdout = StringIO()
+        main(['a.md', 'b.md', '--property-index=index.json', '--where=platform^=ZX', '--output-json'])
+        documents = json.loads(sys.stdout.getvalue())['documents']
+        self.assertEqual([d['filename'] for d in documents], ['a.md'])
+
+    def test_check_links(self):
+        if sys.version_info < (3, 7):
+            return
+        import threading
+        from http.server import BaseHTTPRequestHandler, HTTPServer
+
+        requests = []
+
+        class StubHandler(BaseHTTPRequestHandler):
+            def respond(self):
+                requests.append((self.command, self.path))
+                status = {'/ok': 200, '/missing': 404}.get(self.path, 200)
+                if self.path == '/nohead' and self.command == 'HEAD':
+                    status = 405
+                self.send_response(status)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+            do_HEAD = do_GET = respond
+
+            def log_message(self, *args):
+                pass
+
+        server = HTTPServer(('127.0.0.1', 0), StubHandler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        base = 'http://127.0.0.1:{}'.format(server.server_port)
+        try:
+            with open('a.md', 'w') as f:
+                f.write("""# A
+
+### Entry A
+
+*   see: [this]({0}/ok)
+
+Links: [ok]({0}/ok), [missing]({0}/missing), [no HEAD]({0}/nohead),
+[B](b.md#entry-b), [nope](b.md#nope), [C](c.md), [here](#entry-a).
+
+""".format(base))
+            with open('b.md', 'w') as f:
+                f.write("# B\n\n### Entry B\n\nAlso [ok]({0}/ok).\n\n".format(base))
+
+            with self.assertRaises(SystemExit):
+                main(['a.md', 'b.md', '--check-links', '--link-cache=links.json'])
+            broken = json.loads(sys.stdout.getvalue())
+            self.assertEqual([(link['url'], link['error']) for link in broken], [
+                ('{}/missing'.format(base), 'HTTP status 404'),
+                ('b.md#nope', "No entry with anchor 'nope' in 'b.md'"),
+                ('c.md', "No such file 'c.md'"),
+            ])
+            self.assertEqual(broken[0]['section'], 'Entry A')
+            self.assertEqual(sorted(requests), [
+                ('GET', '/nohead'), ('HEAD', '/missing'), ('HEAD', '/nohead'), ('HEAD', '/ok'),
+            ])
+
+            # results are re-used from the cache
+            sys.stdout = StringIO()
+            with self.assertRaises(SystemExit):
+                main(['a.md', 'b.md', '--check-links', '--link-cache=links.json'])
+            self.assertEqual(json.loads(sys.stdout.getvalue()), broken)
+            self.assertEqual(len(requests), 4)
+        finally:
+            server.shutdown()
+            server.server_close()
+            thread.join()
+
     def test_rewrite_markdown_internal(self):
         with open('foo.md', 'w') as f:
             f.write("""# Document
@@ -70,6 +544,160 @@ Have you heard, [Bubble & Squeak]()?
         self.assert_file_contains('foo.md', '[Bubble & Squeak]: foo.md#bubble--squeak')
         os.unlink('foo.md')
 
+    def test_rewrite_markdown_only_changed(self):
+        with open('foo.md', 'w') as f:
+            f.write("""Document
+========
+
+
+### Entry
+
+*   date: Jan 1 2017 13:45:30
+
+Text.
+""")
+        with open('bar.md', 'w') as f:
+            f.write("""# Document
+
+### Entry
+
+*   date: Jan 1 2017 13:45:30
+Text.
+""")
+        os.utime('foo.md', (0, 0))
+        os.chmod('bar.md', 0o640)
+        saved_stderr = sys.stderr
+        sys.stderr = StringIO()
+        try:
+            main(["foo.md", "bar.md", '--rewrite-markdown'])
+            self.assertEqual(sys.stderr.getvalue(), "Rewrote 1 of 2 documents\n")
+        finally:
+            sys.stderr = saved_stderr
+        self.assertEqual(os.stat('foo.md').st_mtime, 0)
+        self.assertEqual(os.stat('bar.md').st_mode & 0o777, 0o640)
+        with open('foo.md', 'r') as f:
+            foo = f.read()
+        with open('bar.md', 'r') as f:
+            self.assertEqual(f.read(), foo)
+        self.assertEqual(sorted(os.listdir('.')), ['bar.md', 'foo.md'])
+        os.unlink('foo.md')
+        os.unlink('bar.md')
+
+    def test_where_links_with_and_without_jobs(self):
+        # --jobs=1 streams the links, --jobs=2 selects entries with the property index
+        with open('a.md', 'w') as f:
+            f.write("# A\n\nSee [a][].\n\n[a]: http://a/\n\n### Entry A\n\n*   reporter: Nobody\n\nSee [x](http://x/).\n\n")
+        with open('b.md', 'w') as f:
+            f.write("# B\n\nSee [b][].\n\n[b]: http://b/\n\n### Entry B\n\n*   reporter: Somebody\n\nSee [y](http://y/).\n\n")
+
+        def links(jobs):
+            sys.stdout = StringIO()
+            main(['a.md', 'b.md', '--output-links', '--where=reporter=Somebody', '--jobs={}'.format(jobs)])
+            return json.loads(sys.stdout.getvalue())
+
+        self.assertEqual(links(1), links(2))
+        self.assertEqual([link['url'] for link in links(1)], ['http://b/', 'http://y/'])
+        os.unlink('a.md')
+        os.unlink('b.md')
+
+    def test_where_duplicate_titles(self):
+        # entries are selected by position, so one of two same-titled entries can be
+        with open('a.md', 'w') as f:
+            f.write("# A\n\n### Same\n\n*   k: a\n\nFirst.\n\n### Same\n\n*   k: b\n\nSecond.\n")
+        main(['a.md', '--output-json', '--where=k=b'])
+        (document,) = json.loads(sys.stdout.getvalue())['documents']
+        self.assertEqual(
+            [(section['title'], section['properties']['k']) for section in document['sections']],
+            [(u'Same', u'b')]
+        )
+        os.unlink('a.md')
+
+    def test_rewrite_markdown_through_symlink(self):
+        os.mkdir('real')
+        with open('real/bar.md', 'w') as f:
+            f.write("# Document\n\n### Entry\n\n*   date: Jan 1 2017 13:45:30\nText.\n")
+        os.symlink('real/bar.md', 'bar.md')
+        saved_stderr = sys.stderr
+        sys.stderr = StringIO()
+        try:
+            main(["bar.md", '--rewrite-markdown'])
+        finally:
+            sys.stderr = saved_stderr
+        self.assertTrue(os.path.islink('bar.md'))
+        with open('real/bar.md', 'r') as f:
+            self.assertIn('*   date: Jan 1 2017 13:45:30\n\nText.\n', f.read())
+        self.assertEqual(os.listdir('real'), ['bar.md'])
+        os.unlink('bar.md')
+
+    def test_document_cache(self):
+        with open('foo.md', 'w') as f:
+            f.write("""# Document
+
+### Entry
+
+Some text.
+""")
+        main(["foo.md", '--cache-dir=cache', '--output-json'])
+        self.assertEqual(len(os.listdir('cache')), 1)
+        cache = DocumentCache('cache')
+        self.assertEqual(cache.get('foo.md').sections[0].body, u'Some text.')
+
+        with open('foo.md', 'w') as f:
+            f.write("""# Document
+
+### Entry
+
+Some other text.
+""")
+        self.assertIsNone(cache.get('foo.md'))
+        self.assertEqual(read_document_from('foo.md', cache=cache).sections[0].body, u'Some other text.')
+        self.assertEqual(cache.get('foo.md').sections[0].body, u'Some other text.')
+        self.assertEqual(len(os.listdir('cache')), 2)
+
+        DocumentCache('cache', size_limit=0).evict()
+        self.assertEqual(os.listdir('cache'), [])
+
+        main(["foo.md", '--cache-dir=cache', '--output-json'])
+        main(["foo.md", '--cache-dir=cache', '--clear-cache', '--cache-size-limit=1'])
+        self.assertEqual(len(os.listdir('cache')), 1)
+
+        # a file which is saved while it is being parsed does not have the
+        # old parse stored under the key of the new version
+        import feedmark.loader
+
+        class SavingParser(Parser):
+            def parse_document(self):
+                document = Parser.parse_document(self)
+                with open('foo.md', 'w') as f:
+                    f.write("# New Title\n\n### Entry\n\nSome newer text.\n\n")
+                os.utime('foo.md', (0, 3000000))
+                return document
+
+        cache.clear()
+        feedmark.loader.Parser = SavingParser
+        try:
+            self.assertEqual(read_document_from('foo.md', cache=cache).title, u'Document')
+        finally:
+            feedmark.loader.Parser = Parser
+        self.assertIsNone(cache.get('foo.md'))
+        self.assertEqual(read_document_from('foo.md', cache=cache).title, u'New Title')
+        self.assertEqual(cache.get('foo.md').title, u'New Title')
+        os.unlink('foo.md')
+
+    def test_html_fragment_cache(self):
+        args = ["{}/eg/Referenced Llama Sightings.md".format(self.prevdir), '--output-json', '--htmlized-json']
+        main(args)
+        expected = sys.stdout.getvalue()
+        sys.stdout = StringIO()
+        main(args + ['--html-fragment-cache=fragments.json'])
+        self.assertEqual(sys.stdout.getvalue(), expected)
+        cache = FragmentCache()
+        cache.load('fragments.json')
+        self.assertIn(u'<a href="mall.html">the mall</a>', [html for html in cache.entries.values()])
+        sys.stdout = StringIO()
+        main(args + ['--html-fragment-cache=fragments.json'])
+        self.assertEqual(sys.stdout.getvalue(), expected)
+
 
 class TestFeedmarkCommandLine(unittest.TestCase):
 
@@ -300,6 +928,127 @@ class TestFeedmarkCommandLine(unittest.TestCase):
         output = sys.stdout.getvalue()
         self.assertIn('[2 Llamas Spotted Near Mall]: eg/Recent%20Llama%20Sightings.md#2-llamas-spotted-near-mall', output)
 
+    def test_by_property_streamed(self):
+        filenames = ['eg/Recent Llama Sightings.md', 'eg/Referenced Llama Sightings.md']
+        main(filenames + ['--by-property'])
+        streamed_output = sys.stdout.getvalue()
+        sys.stdout = StringIO()
+        main(filenames + ['--by-property', '--output-json'])
+        self.assertTrue(sys.stdout.getvalue().endswith(streamed_output))
+        self.assertEqual(json.loads(streamed_output)['reporter'], {u'A Possible Llama Under the Bridge': u'Gregor Samsa'})
+
+    def test_jobs(self):
+        filenames = ['eg/Recent Llama Sightings.md', 'eg/Ancient Llama Sightings.md', 'eg/Referenced Llama Sightings.md']
+        for mode in (['--output-json', '--htmlized-json'], ['--output-markdown'], ['--output-html']):
+            main(filenames + mode)
+            serial_output = sys.stdout.getvalue()
+            sys.stdout = StringIO()
+            main(filenames + mode + ['--jobs=3'])
+            self.assertEqual(sys.stdout.getvalue(), serial_output)
+            sys.stdout = StringIO()
+
+    def test_by_publication_date(self):
+        main(['eg/Ancient Llama Sightings.md', 'eg/Recent Llama Sightings.md', '--by-publication-date'])
+        data = json.loads(sys.stdout.getvalue())
+        self.assertEqual([item['title'] for item in data], [
+            u'2 Llamas Spotted Near Mall',
+            u'A Possible Llama Under the Bridge',
+            u"Llamas: It's Time to Spot Them",
+            u'Maybe sighting the llama',
+        ])
+        self.assertEqual(
+            data[0]['url'],
+            u'https://codeberg.org/catseye/Feedmark/src/branch/master/eg/Recent%20Llama%20Sightings.md#2-llamas-spotted-near-mall'
+        )
+        sys.stdout = StringIO()
+        main(['eg/Ancient Llama Sightings.md', 'eg/Recent Llama Sightings.md', '--by-publication-date', '--limit=2'])
+        self.assertEqual(json.loads(sys.stdout.getvalue()), data[:2])
+
+    def test_serve(self):
+        import threading
+        from feedmark.server import Corpus, make_server, query
+
+        filenames = ['eg/Recent Llama Sightings.md', 'eg/Ancient Llama Sightings.md']
+        corpus = Corpus(filenames, refdex_filenames=['eg/refdex.json'])
+        server = make_server(corpus, port=0)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        try:
+            base_url = 'http://127.0.0.1:{}'.format(server.server_port)
+            for (name, params, options) in (
+                ('json', {}, ['--output-json']),
+                ('json', {'htmlize': 1, 'ordered': 1}, ['--output-json', '--htmlized-json', '--ordered-json']),
+                ('by-publication-date', {'limit': 1}, ['--by-publication-date', '--limit=1']),
+                ('by-property', {}, ['--by-property']),
+                ('refdex', {'single_filename': 1}, ['--output-refdex', '--output-refdex-single-filename']),
+            ):
+                sys.stdout = StringIO()
+                main(filenames + ['--input-refdex=eg/refdex.json'] + options)
+                self.assertEqual(query(name, base_url=base_url, **params), json.loads(sys.stdout.getvalue()))
+            data = query('json', base_url=base_url, document='eg/Ancient Llama Sightings.md')
+            self.assertEqual([d['title'] for d in data['documents']], [u'Ancient Llama Sightings'])
+            self.assertIn(u'<h3 id="a-possible-llama-under-the-bridge">', query('html', base_url=base_url))
+            with self.assertRaises(LookupError):
+                query('json', base_url=base_url, document='eg/Nonexistent.md')
+        finally:
+            server.shutdown()
+            server.server_close()
+            thread.join()
+
+    def test_where(self):
+        filenames = ['eg/Recent Llama Sightings.md', 'eg/Ancient Llama Sightings.md', 'eg/Referenced Llama Sightings.md']
+
+        def titles(*conditions):
+            sys.stdout = StringIO()
+            main(filenames + ['--output-json'] + ['--where={}'.format(c) for c in conditions])
+            return [
+                (document['title'], [section['title'] for section in document['sections']])
+                for document in json.loads(sys.stdout.getvalue())['documents']
+            ]
+
+        self.assertEqual(titles('reporter=Gregor Samsa'), [
+            (u'Recent Llama Sightings', [u'A Possible Llama Under the Bridge']),
+        ])
+        self.assertEqual(titles('date^=Nov 1'), [
+            (u'Recent Llama Sightings', [u"Llamas: It's Time to Spot Them"]),
+            (u'Referenced Llama Sightings', [u"Llamas: It's Time to Spot Them"]),
+        ])
+        self.assertEqual(titles('spotted=[the lumberyard](lumberyard.html)'), [
+            (u'Referenced Llama Sightings', [u"Llamas: It's Time to Spot Them"]),
+        ])
+        self.assertEqual(titles('date~=19[0-9][0-9]'), [
+            (u'Ancient Llama Sightings', [u'Maybe sighting the llama']),
+        ])
+        self.assertEqual(titles('date~=201[67]', 'date^=Jan'), [
+            (u'Recent Llama Sightings', [u'2 Llamas Spotted Near Mall']),
+        ])
+        self.assertEqual(titles('reporter=Nobody'), [])
+
+        # the streaming modes select the same entries
+        sys.stdout = StringIO()
+        main(filenames + ['--by-property', '--where=date^=Nov 1'])
+        self.assertEqual(json.loads(sys.stdout.getvalue())['hopper'], {
+            u"Llamas: It's Time to Spot Them": u'[Grace](https://en.wikipedia.org/wiki/Grace_Hopper)'
+        })
+
+    def test_import_time(self):
+        if sys.version_info < (3, 7):
+            return
+        from feedmark.benchmarks import import_times
+
+        # modes which only parse documents do not import the libraries used to produce other formats
+        for mode in (
+            ['--version'], ['--output-refdex'], ['--dump-entries'], ['--by-property'],
+            ['--output-json'], ['--output-markdown'], ['--by-publication-date'],
+        ):
+            args = mode if mode == ['--version'] else ['eg/Recent Llama Sightings.md'] + mode
+            times = import_times(args)
+            self.assertIn('feedmark.main', times)
+            for name in ('markdown', 'bs4', 'atomize'):
+                self.assertNotIn(name, times, "{} imported {}".format(mode, name))
+        times = import_times(['--version'])
+        self.assertLess(times['feedmark.main'], IMPORT_TIME_BUDGET)
+
     def test_output_links(self):
         main(['eg/Ill-formed Llama Sightings.md', '--output-links'])
         data = json.loads(sys.stdout.getvalue())
@@ -320,6 +1069,126 @@ class TestFeedmarkCommandLine(unittest.TestCase):
 
 class TestFeedmarkInternals(unittest.TestCase):
 
+    def test_link_checker_stale_connections(self):
+        if sys.version_info < (3, 7):
+            return
+        import threading
+        from http.server import BaseHTTPRequestHandler, HTTPServer
+        from feedmark.linkcheck import LinkChecker
+
+        active = []
+        peak = []
+        lock = threading.Lock()
+
+        class ClosingHandler(BaseHTTPRequestHandler):
+            # claims keep-alive, but closes the connection after each response
+            protocol_version = 'HTTP/1.1'
+
+            def do_HEAD(self):
+                with lock:
+                    active.append(self.path)
+                    peak.append(len(active))
+                time.sleep(0.01)
+                self.send_response(200)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                self.close_connection = True
+                with lock:
+                    active.remove(self.path)
+
+            def log_message(self, *args):
+                pass
+
+        from socketserver import ThreadingMixIn
+
+        class Server(ThreadingMixIn, HTTPServer):
+            daemon_threads = True
+
+        servers = [Server(('127.0.0.1', 0), ClosingHandler) for n in range(4)]
+        threads = [threading.Thread(target=server.serve_forever) for server in servers]
+        for thread in threads:
+            thread.start()
+        try:
+            urls = [
+                'http://127.0.0.1:{}/{}'.format(server.server_port, name)
+                for server in servers for name in ('a', 'b', 'c')
+            ]
+            checker = LinkChecker(connections=2, workers=3)
+            results = checker.check_urls(urls)
+            self.assertEqual(dict((url, result['error']) for (url, result) in results.items()), dict((url, None) for url in urls))
+            self.assertLessEqual(max(peak), 3)
+        finally:
+            for server in servers:
+                server.shutdown()
+                server.server_close()
+            for thread in threads:
+                thread.join()
+
+    def test_link_checker_idle_connection_race(self):
+        if sys.version_info < (3, 7):
+            return
+        from feedmark.linkcheck import Host
+
+        class TakenList(list):
+            # as if another thread took the last idle connection after this
+            # one saw that there was one
+            def __bool__(self):
+                return True
+
+        host = Host('http', 'example.com', 2, None)
+        host.idle = TakenList()
+        (conn, reused) = host.connect(1.0)
+        self.assertFalse(reused)
+        self.assertEqual(conn.host, 'example.com')
+
+    def test_internal_links(self):
+        if sys.version_info < (3, 7):
+            return
+        from feedmark.linkcheck import InternalLinks
+
+        document = read_document_from('eg/Recent Llama Sightings.md')
+        internal = InternalLinks([document], refdex={
+            u'Elsewhere': {u'filenames': [u'elsewhere/Other.md'], u'anchor': u'other-entry'},
+        })
+        self.assertIsNone(internal.check('eg/Recent%20Llama%20Sightings.md#2-llamas-spotted-near-mall'))
+        self.assertIsNone(internal.check('Recent%20Llama%20Sightings.md#2-llamas-spotted-near-mall', document_filename='eg/x.md'))
+        self.assertIsNone(internal.check('#a-possible-llama-under-the-bridge', document_filename=document.filename))
+        self.assertIsNone(internal.check('elsewhere/Other.md#other-entry'))
+        self.assertEqual(internal.check('elsewhere/Other.md#no-entry'), "No such file 'elsewhere/Other.md'")
+        self.assertEqual(
+            internal.check('eg/Recent%20Llama%20Sightings.md#nope'),
+            "No entry with anchor 'nope' in 'eg/Recent Llama Sightings.md'"
+        )
+
+    def test_extract_links(self):
+        from feedmark.checkers import extract_links, extract_links_from_documents
+
+        self.assertEqual(
+            extract_links('<p><a href="x&amp;y">a</a> <A HREF=z>b</A> <a name="n">c</a> <a href="q"/></p>'),
+            [u'x&y', u'z', None, u'q']
+        )
+        document = Parser("""# Document
+
+### Entry
+
+![photo](photo.jpg)
+[![linked photo](thumb.jpg)](full.jpg)
+
+*   see: [elsewhere](http://example.com/elsewhere)
+*   plain: No links here
+
+See <http://example.com/auto> and <a href="http://example.com/raw">this</a>.
+
+""").parse_document()
+        self.assertEqual([(link['url'], link.get('name')) for link in extract_links_from_documents([document])], [
+            (u'photo.jpg', u'photo'),
+            (u'thumb.jpg', u'linked photo'),
+            (u'full.jpg', u'linked photo'),
+            (u'http://example.com/elsewhere', None),
+            (u'http://example.com/auto', None),
+            (u'http://example.com/raw', None),
+        ])
+
     def test_load_documents(self):
         doc1 = read_document_from('eg/Ancient Llama Sightings.md')
         self.assertEqual(doc1.title, "Ancient Llama Sightings")
@@ -336,6 +1205,297 @@ class TestFeedmarkInternals(unittest.TestCase):
         results = schema.check_documents([doc1, doc2])
         self.assertEqual(results, [])
 
+    def test_schema_number_types(self):
+        from feedmark.checkers import check_integer, check_number
+
+        for value in (u'0', u'42', u'-7'):
+            check_integer(value)
+        for value in (u'1_000', u'+1', u' 1', u'1.0', u'nan', u'', u'\u0661'):
+            self.assertRaises(ValueError, check_integer, value)
+        for value in (u'0', u'-4.5', u'4.', u'.5', u'1e10', u'2.5E-3'):
+            check_number(value)
+        for value in (u'1_000.5', u'nan', u'inf', u'-Infinity', u'1e', u'.', u'', u'0x10'):
+            self.assertRaises(ValueError, check_number, value)
+
+    def test_schema_values(self):
+        schema = Schema(Parser("""# Game Schema
+
+### year
+
+*   type: integer
+*   pattern: (19|20)[0-9][0-9]
+
+### platform
+
+*   multiple: true
+*   max-count: 2
+*   allowed @ ZX Spectrum
+*   allowed @ Commodore 64
+*   allowed @ Amiga
+
+### released
+
+*   optional: true
+*   date-format: %b %d %Y
+
+### rating
+
+*   optional: true
+*   type: number
+
+Out of five.
+
+""").parse_document())
+        document = Parser("""# Games
+
+### Good
+
+*   year: 1984
+*   platform @ ZX Spectrum
+*   released: Mar 1 1984
+
+### Bad
+
+*   developer: Nobody
+*   year: 84
+*   platform @ ZX Spectrum
+*   platform @ Amiga
+*   platform @ Atari ST
+*   released: 1984-03-01
+*   rating: great
+*   publisher: Nobody
+
+### Also Bad
+
+*   platform: Amiga
+*   rating: 4.5
+
+A game.
+
+""").parse_document()
+        results = schema.check_documents([document])
+        self.assertEqual(results, [
+            {
+                'document': u'Games',
+                'section': u'Bad',
+                'result': [
+                    ['extra', u'developer'],
+                    ['extra', u'publisher'],
+                    ['invalid', u'year', u"'84' does not match pattern '(19|20)[0-9][0-9]'"],
+                    ['invalid', u'platform', u'has 3 values, more than 2'],
+                    ['invalid', u'platform', u"'Atari ST' is not one of the allowed values"],
+                    ['invalid', u'released', u"'1984-03-01' is not a date in the format '%b %d %Y'"],
+                    ['invalid', u'rating', u"'great' is not of type number"],
+                ]
+            },
+            {
+                'document': u'Games',
+                'section': u'Also Bad',
+                'result': [
+                    ['missing', u'year'],
+                    ['invalid', u'platform', u"must be given with '@'"],
+                ]
+            },
+        ])
+        self.assertEqual(schema.check_documents([document, document], jobs=2), results + results)
+
+    def test_markdown_to_html5_with_reference_links(self):
+        reference_links = ReferenceLinks([(u'llama', u'llama.html'), (u'Mall', u'mall.html "The Mall"')])
+        self.assertEqual(
+            markdown_to_html5(u'A [llama][] at [the mall][mall].', reference_links=reference_links),
+            u'<p>A <a href="llama.html">llama</a> at <a href="mall.html" title="The Mall">the mall</a>.</p>'
+        )
+        # definitions given with the snippet are overridden by the shared ones, as if they were appended to it
+        self.assertEqual(
+            markdown_to_html5(u'A [llama][].\n\n[llama]: alpaca.html', reference_links=reference_links),
+            u'<p>A <a href="llama.html">llama</a>.</p>'
+        )
+        self.assertEqual(
+            markdown_to_html5_deep({u'seen': [u'[llama][]', u'*no*']}, reference_links=reference_links),
+            {u'seen': [u'<a href="llama.html">llama</a>', u'<em>no</em>']}
+        )
+
+    def test_fragment_cache(self):
+        cache = FragmentCache(maxsize=2)
+        self.assertIsNone(cache.get(('a', '')))
+        cache.put(('a', ''), 'A')
+        cache.put(('b', ''), 'B')
+        self.assertEqual(cache.get(('a', '')), 'A')
+        cache.put(('c', ''), 'C')
+        self.assertIsNone(cache.get(('b', '')))
+        self.assertEqual(cache.get(('c', '')), 'C')
+        self.assertEqual((cache.hits, cache.misses), (2, 2))
+
+    def test_iter_sections(self):
+        for filename in ('eg/Recent Llama Sightings.md', 'eg/Referenced Llama Sightings.md'):
+            document = read_document_from(filename)
+            stream = iter_sections_from(filename)
+            streamed_document = next(stream)
+            self.assertEqual(streamed_document.title, document.title)
+            self.assertEqual(streamed_document.properties, document.properties)
+            self.assertEqual(streamed_document.reference_links, document.reference_links)
+            self.assertEqual(streamed_document.sections, [])
+            streamed_sections = list(stream)
+            self.assertEqual(
+                [(s.title, s.properties, s.images, s.body, s.reference_links) for s in streamed_sections],
+                [(s.title, s.properties, s.images, s.body, s.reference_links) for s in document.sections]
+            )
+            self.assertTrue(all(s.document is streamed_document for s in streamed_sections))
+
+    def test_split_lines(self):
+        # io.StringIO, as feedmark.utils.StringIO takes no newline argument on Python 2
+        import io
+        for text in (u'', u'a', u'a\n', u'a\r\nb\n\n', u'\n\nc'):
+            self.assertEqual(list(split_lines(io.StringIO(text, newline='\n'))), text.split(u'\n'))
+
+    def test_publication_date(self):
+        document = Parser(u"""# Document
+
+### Usual
+
+*   date: Jan 1 2017 13:45:30
+
+### Spelled differently
+
+*   date: jan  1 2017 13:45:30
+
+### RFC 822
+
+*   date: Sun, 01 Jan 2017 13:45:30 GMT
+
+### ISO 8601
+
+*   date: 2017-01-01T13:45:30
+
+### Undated
+
+No date was given for this one.
+""").parse_document()
+        (usual, spelled, rfc822, iso8601, undated) = document.sections
+        self.assertEqual(usual.publication_date, datetime(2017, 1, 1, 13, 45, 30))
+        self.assertEqual(spelled.publication_date, usual.publication_date)
+        self.assertEqual(rfc822.publication_date, usual.publication_date)
+        with self.assertRaises(NotImplementedError):
+            iso8601.publication_date
+        with self.assertRaises(KeyError):
+            undated.publication_date
+        self.assertIs(usual.publication_date, usual.publication_date)
+
+        saved_date_formats = list(DATE_FORMATS)
+        try:
+            register_date_format("%Y-%m-%dT%H:%M:%S")
+            self.assertEqual(iso8601.publication_date, usual.publication_date)
+        finally:
+            DATE_FORMATS[:] = saved_date_formats
+
+    def test_write_markdown(self):
+        document = read_document_from('eg/Referenced Llama Sightings.md')
+        out = StringIO()
+        write_markdown(document, out)
+        self.assertEqual(out.getvalue(), feedmark_markdownize(document))
+        self.assertTrue(out.getvalue().startswith(u"""Referenced Llama Sightings
+==========================
+
+*   author: Alfred J. Prufrock
+"""))
+        self.assertIn(u"""
+### Llamas: It's Time to Spot Them
+
+*   date: Nov 1 2016 09:00:00
+""", out.getvalue())
+
+    def test_htmlize_section_wise(self):
+        for filename in ('eg/Recent Llama Sightings.md', 'eg/Referenced Llama Sightings.md'):
+            document = read_document_from(filename)
+            self.assertEqual(feedmark_htmlize(document), feedmark_htmlize_whole(document))
+        # two sections with the same title need distinct heading ids, which only
+        # converting the whole document at once provides
+        document = Parser(u"""# Document
+
+### Entry
+
+One.
+
+### Entry
+
+Two.
+""").parse_document()
+        html = feedmark_htmlize(document)
+        self.assertEqual(html, feedmark_htmlize_whole(document))
+        self.assertIn(u'<h3 id="entry">Entry</h3>', html)
+        self.assertIn(u'<h3 id="entry_1">Entry</h3>', html)
+
+    def test_parse_line_kinds(self):
+        document = Parser(u"""# Document
+
+*   key @ value: with colon
+*   other: value @ with at
+
+### Entry ###
+
+[![linked](image.png)](page.html)
+![plain](image2.png)
+
+*   date: Jan 1 2017 13:45:30
+
+Body text with a [link][] in it.
+
+[link]: http://example.com/
+""").parse_document()
+        self.assertEqual(list(document.properties.items()), [
+            (u'key', [u'value: with colon']),
+            (u'other: value', [u'with at']),
+        ])
+        section = document.sections[0]
+        self.assertEqual(section.title, u'Entry')
+        self.assertEqual(section.images, [
+            {u'description': u'linked', u'source': u'image.png', u'link': u'page.html'},
+            {u'description': u'plain', u'source': u'image2.png'},
+        ])
+        self.assertEqual(section.properties[u'date'], u'Jan 1 2017 13:45:30')
+        self.assertEqual(section.body, u'Body text with a [link][] in it.\n')
+        self.assertEqual(section.reference_links, [(u'link', u'http://example.com/')])
+
+    def test_compact_documents(self):
+        import pickle
+
+        document = Parser(u"""# Document
+
+### First
+
+*   platform: ZX Spectrum
+
+Some
+text.
+
+### Second
+
+*   platform: Commodore 64
+
+More text.
+""").parse_document()
+        for obj in [document] + document.sections:
+            self.assertFalse(hasattr(obj, '__dict__'))
+            with self.assertRaises(AttributeError):
+                obj.unknown = 1
+        (first, second) = document.sections
+        self.assertEqual(first.body, u'Some\ntext.\n')
+        self.assertEqual(first.lines, [u'Some', u'text.', u''])
+        first.lines = [u'Other', u'text.']
+        self.assertEqual(first.body, u'Other\ntext.')
+        if sys.version_info[0] >= 3:
+            # property keys are interned, so are shared by every section
+            (key1,) = first.properties.keys()
+            (key2,) = second.properties.keys()
+            self.assertIs(key1, key2)
+
+        # documents must still pickle, for the document cache
+        copy = pickle.loads(pickle.dumps(document, 2))
+        self.assertEqual(copy.title, u'Document')
+        self.assertEqual([s.title for s in copy.sections], [u'First', u'Second'])
+        self.assertEqual(copy.sections[0].body, u'Other\ntext.')
+        self.assertEqual(copy.sections[1].properties[u'platform'], u'Commodore 64')
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,112 @@
+# Support for `feedmark --timings`: record how long each phase of a run (and
+# the reading of each document) took, how many times it was entered, and
+# (optionally) how much memory was allocated at its peak, and report it all
+# as JSON.
+
+import json
+import sys
+import time
+
+
+def timed(fun, arg):
+    """Return `fun(arg)` and the number of seconds it took, as a pair.
+    Suitable for passing (with `functools.partial`) to `pool_map`."""
+    start = time.time()
+    result = fun(arg)
+    return (result, time.time() - start)
+
+
+class Timings(object):
+    """Records the phases of a run.  Beginning a phase (with `phase`) ends the
+    one before it, so that phases can be marked as a run proceeds without
+    restructuring the code which makes them up.  Does nothing until enabled.
+
+    Peak memory is only measured if asked for, as it is measured with
+    `tracemalloc`, which slows everything down (and allocation-heavy phases
+    more than others), making the times less accurate.  It is the peak since
+    the phase began on Python 3.9 and later, and since timings were enabled on
+    earlier versions.  It is not available on Python 2."""
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        """Discard all timings, and disable."""
+        if getattr(self, 'tracemalloc', None) is not None:
+            self.tracemalloc.stop()
+        self.enabled = False
+        self.tracemalloc = None
+        self.started = None
+        self.phases = []
+        self.by_name = {}
+        self.documents = {}
+        self.current = None
+
+    def enable(self, memory=False):
+        self.enabled = True
+        self.started = time.time()
+        if memory:
+            try:
+                import tracemalloc
+            except ImportError:
+                pass
+            else:
+                tracemalloc.start()
+                self.tracemalloc = tracemalloc
+
+    def phase(self, name):
+        if not self.enabled:
+            return
+        self.end_phase()
+        record = self.by_name.get(name)
+        if record is None:
+            record = {'name': name, 'calls': 0, 'seconds': 0.0, 'peak_memory': None}
+            self.by_name[name] = record
+            self.phases.append(record)
+        record['calls'] += 1
+        if self.tracemalloc is not None and hasattr(self.tracemalloc, 'reset_peak'):
+            self.tracemalloc.reset_peak()
+        self.current = (record, time.time())
+
+    def end_phase(self):
+        if self.current is None:
+            return
+        (record, start) = self.current
+        self.current = None
+        record['seconds'] += time.time() - start
+        if self.tracemalloc is not None:
+            peak = self.tracemalloc.get_traced_memory()[1]
+            record['peak_memory'] = max(peak, record['peak_memory'] or 0)
+
+    def document(self, filename, phase, seconds):
+        if self.enabled:
+            by_phase = self.documents.setdefault(filename, {})
+            by_phase[phase] = by_phase.get(phase, 0.0) + seconds
+
+    def to_json_data(self):
+        self.end_phase()
+        data = {
+            'seconds': time.time() - self.started,
+            'phases': self.phases,
+            'documents': self.documents,
+        }
+        try:
+            import resource
+        except ImportError:
+            pass
+        else:
+            # kilobytes on Linux, bytes on macOS
+            data['max_rss'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return data
+
+    def report(self, filename=None):
+        """Write the timings as JSON to the named file, or to standard error."""
+        text = json.dumps(self.to_json_data(), indent=4, sort_keys=True)
+        if filename is None:
+            sys.stderr.write(text + '\n')
+        else:
+            with open(filename, 'w') as f:
+                f.write(text)
+
+
+timings = Timings()
@@ -1,3 +1,7 @@
+from contextlib import contextmanager
+import json
+import os
+
 # Python 2/3
 try:
     unicode = unicode
@@ -10,6 +14,13 @@ except ImportError:
     from io import StringIO
 assert StringIO
 
+try:
+    from sys import intern
+except ImportError:
+    # Python 2's intern() only accepts byte strings.
+    def intern(s):
+        return s
+
 try:
     from urllib import quote, quote_plus
 except ImportError:
@@ -31,3 +42,99 @@ def items_in_priority_order(di, priority):
     for key, item in sorted(items(di)):
         if key not in priority:
             yield key, item
+
+
+def write_json_list(iterable, f):
+    """Write the items of `iterable` to `f` as a JSON list, formatted as
+    `json.dumps(list(iterable), indent=4, sort_keys=True)` would format it,
+    but without holding the whole list in memory."""
+    first = True
+    for item in iterable:
+        f.write('[\n' if first else ',\n')
+        f.write('\n'.join('    ' + line for line in json.dumps(item, indent=4, sort_keys=True).split('\n')))
+        first = False
+    f.write('[]' if first else '\n]')
+
+
+def copy_file_mode(filename, temp_filename):
+    """Give the file `temp_filename`, which is about to replace `filename`,
+    the mode of `filename`; or, if there is no such file, the mode which
+    `open` would give a new file (the temporary file is only readable by
+    its owner.)"""
+    if os.path.exists(filename):
+        import shutil
+        shutil.copymode(filename, temp_filename)
+    else:
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(temp_filename, 0o666 & ~umask)
+
+
+@contextmanager
+def replacing_file(filename):
+    """Context manager which yields a binary file to write the new contents of
+    `filename` to.  It is a temporary file alongside it, which is renamed over
+    it if the block completes, and removed if it does not, so the file is
+    never left partly written.  If `filename` is a symbolic link, the file it
+    links to is the one which is replaced."""
+    import tempfile
+
+    filename = os.path.realpath(filename)
+    (dirname, basename) = os.path.split(filename)
+    (fd, temp_filename) = tempfile.mkstemp(dir=dirname or '.', prefix='.' + basename + '.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            yield f
+        copy_file_mode(filename, temp_filename)
+        getattr(os, 'replace', os.rename)(temp_filename, filename)
+    except:
+        os.unlink(temp_filename)
+        raise
+
+
+def write_file_if_changed(filename, text, encoding='utf-8'):
+    """Write `text` to the file `filename`, unless the file already contains
+    exactly that text.  The file is replaced atomically (see `replacing_file`.)
+    Returns True if the file was written."""
+    data = text.encode(encoding)
+    try:
+        with open(filename, 'rb') as f:
+            if f.read() == data:
+                return False
+    except IOError:
+        pass
+    with replacing_file(filename) as f:
+        f.write(data)
+    return True
+
+
+def pool_map(fun, iterable, jobs=1):
+    """Return the list of results of applying `fun` to every item of `iterable`,
+    in order.  If `jobs` is greater than 1, the work is spread across a pool of
+    that many worker processes; `fun` and the items must then be picklable."""
+    if jobs is None or jobs <= 1:
+        return [fun(item) for item in iterable]
+    from multiprocessing import Pool
+    pool = Pool(jobs)
+    try:
+        return pool.map(fun, iterable)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def pool_imap(fun, iterable, jobs=1, chunksize=16):
+    """Like `pool_map`, but yield the results one at a time, in order, as they
+    become available, so that they need not all be held in memory at once."""
+    if jobs is None or jobs <= 1:
+        for item in iterable:
+            yield fun(item)
+        return
+    from multiprocessing import Pool
+    pool = Pool(jobs)
+    try:
+        for result in pool.imap(fun, iterable, chunksize):
+            yield result
+    finally:
+        pool.close()
+        pool.join()
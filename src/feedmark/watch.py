@@ -0,0 +1,118 @@
+# Support for `feedmark --watch`: keep the parsed documents in memory, and
+# re-read only those input files which change.
+
+import os
+import sys
+import time
+
+
+def stamp_of(filename):
+    """Return something which changes whenever the given file changes,
+    or None if it does not exist."""
+    try:
+        st = os.stat(filename)
+    except OSError:
+        return None
+    return (st.st_size, getattr(st, 'st_mtime_ns', st.st_mtime))
+
+
+class Watcher(object):
+    """Keeps the parsed Documents for a list of input files, and re-reads
+    (with `load`) only the ones which have changed since they were last read.
+
+    Changes to any of the `dependencies` (refdexes, schema) are noticed too;
+    they mean that the output of every document may have changed.
+
+    Rewriting reference links modifies documents in place, so the reference
+    links of each document are remembered as they were when it was read, and
+    are restored before the documents are processed again.  When the refdex
+    entries have not changed, rewriting the links again would give the same
+    result, so only the links of the affected documents are restored."""
+
+    def __init__(self, filenames, load, dependencies=()):
+        self.filenames = list(filenames)
+        self.dependencies = list(dependencies)
+        self.load = load
+        self.stamps = dict(
+            (filename, stamp_of(filename)) for filename in self.filenames + self.dependencies
+        )
+        self.documents = {}
+        self.reference_links = {}
+
+    def set_document(self, document):
+        self.documents[document.filename] = document
+        self.reference_links[document.filename] = (
+            document.reference_links, [section.reference_links for section in document.sections]
+        )
+
+    def get_documents(self, affected=None):
+        """Return the documents in input order, with the reference links of
+        those in `affected` (or of all of them, if it is None) restored."""
+        documents = []
+        for filename in self.filenames:
+            document = self.documents[filename]
+            documents.append(document)
+            if affected is not None and filename not in affected:
+                continue
+            (reference_links, section_reference_links) = self.reference_links[filename]
+            document.reference_links = reference_links
+            for (section, reference_links) in zip(document.sections, section_reference_links):
+                section.reference_links = reference_links
+        return documents
+
+    def poll(self):
+        """Re-read any input files which have changed since the last poll.
+        Returns a pair: the list of files which changed, and the set of
+        filenames of the documents whose outputs are affected.  The latter is
+        None if that could be all of them (because a dependency changed, or a
+        section was added, removed, or retitled, which can change how links in
+        other documents are rewritten.)"""
+        changed = []
+        for filename in self.filenames + self.dependencies:
+            stamp = stamp_of(filename)
+            if stamp != self.stamps[filename]:
+                self.stamps[filename] = stamp
+                changed.append(filename)
+        if not changed:
+            return (changed, set())
+
+        from feedmark.refdex import refdex_entries_of
+
+        affected = set()
+        for filename in changed:
+            if filename not in self.documents:
+                affected = None
+                continue
+            try:
+                document = self.load(filename)
+            except Exception as e:
+                # probably saved mid-edit; keep the previous version until it is saved again
+                sys.stderr.write("Could not read '{}': {}\n".format(filename, e))
+                continue
+            if refdex_entries_of(document) != refdex_entries_of(self.documents[filename]):
+                affected = None
+            self.set_document(document)
+            if affected is not None:
+                affected.add(filename)
+        return (changed, affected)
+
+    def watch(self, process, interval=0.05):
+        """Whenever something changes, call `process` with the documents and the
+        set of affected filenames (or None).  Runs until interrupted."""
+        try:
+            while True:
+                time.sleep(interval)
+                start = time.time()
+                (changed, affected) = self.poll()
+                if not changed:
+                    continue
+                try:
+                    process(self.get_documents(affected), affected=affected)
+                except Exception as e:
+                    sys.stderr.write("Could not process documents: {}\n".format(e))
+                    continue
+                finally:
+                    sys.stdout.flush()
+                sys.stderr.write("Processed {} changed files in {:.3f}s\n".format(len(changed), time.time() - start))
+        except KeyboardInterrupt:
+            pass